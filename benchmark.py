@@ -0,0 +1,223 @@
+""" Headless benchmarks of the hot paths in main.py.
+
+Runs without opening a window or starting the reactor, and prints the results
+as JSON so they can be compared between builds:
+
+    python benchmark.py > before.json
+    python benchmark.py --output after.json
+
+"""
+
+import argparse
+import json
+import math
+import os
+import platform
+import time
+import timeit
+
+import pyglet
+
+# There is no GL context to share, and vertex lists must live in client
+# memory rather than in buffer objects.
+pyglet.options['shadow_window'] = False
+pyglet.options['graphics_vbo'] = False
+
+# main.py loads its textures relative to the working directory.
+os.chdir(os.path.dirname(os.path.abspath(__file__)))
+
+import main
+
+
+def measure(func, number, repeat):
+    """ Run `func` `number` times, `repeat` times over, and return the best
+    time per call in seconds.
+
+    """
+    return min(timeit.repeat(func, number=number, repeat=repeat)) / number
+
+
+def new_model(seed):
+    """ Return a `main.Model` with the sectors around the origin shown.
+
+    """
+    model = main.Model(seed=seed)
+    model.change_sectors(None, (0, 0, 0))
+    model.process_entire_queue()
+    return model
+
+
+def bench_generation(seed, repeat):
+    generator = main.TerrainGenerator(seed, main.blockRegistry)
+    # The sectors holding the ground.
+    sectors = [(x, -1, z) for x in xrange(-4, 5) for z in xrange(-4, 5)]
+
+    def run():
+        for sector in sectors:
+            main.generate_sector_job(generator, sector)
+    return {
+        'sector': measure(run, 1, repeat) / len(sectors),
+    }
+
+
+def bench_sectors(seed, repeat):
+    def show():
+        new_model(seed)
+
+    def spawn():
+        # What the game builds before its first frame; the rest of the
+        # sectors stream in afterwards.
+        model = main.Model(seed=seed)
+        model.ensure_generated((0, 0, 0))
+        model.change_sectors(None, (0, 0, 0))
+        model.load_around((0, 0, 0))
+
+    model = new_model(seed)
+    positions = [(0, 0, 0), (1, 0, 0), (1, 0, 1), (0, 0, 1)]
+    state = {'index': 0}
+
+    def move():
+        before = positions[state['index'] % len(positions)]
+        state['index'] += 1
+        after = positions[state['index'] % len(positions)]
+        model.change_sectors(before, after)
+        model.process_entire_queue()
+
+    best = measure(show, 1, repeat)
+    return {
+        'show_all': best,
+        'show_sector': best / len(model.shown),
+        'spawn': measure(spawn, 1, repeat),
+        'move': measure(move, len(positions), repeat),
+    }
+
+
+def bench_blocks(model, repeat):
+    block = main.BLOCKS['BRICK']
+    positions = [(x, 5, z) for x in xrange(-8, 8) for z in xrange(-8, 8)]
+
+    def edit(immediate):
+        for position in positions:
+            model.add_block(position, block, immediate)
+        for position in positions:
+            model.remove_block(position, immediate)
+        # Without `immediate`, edited sectors are only marked dirty, and
+        # rebuilt once each when the queue is processed.
+        model.process_entire_queue()
+
+    return {
+        'add_remove': measure(lambda: edit(False), 1, repeat) /
+            (2 * len(positions)),
+        'add_remove_immediate': measure(lambda: edit(True), 1, repeat) /
+            (2 * len(positions)),
+    }
+
+
+def bench_hit_test(model, repeat):
+    rays = []
+    for i in xrange(64):
+        x = math.radians(i * 360.0 / 64)
+        y = math.radians(-60 + (i % 8) * 15)
+        m = math.cos(y)
+        rays.append((math.cos(x) * m, math.sin(y), math.sin(x) * m))
+    position = (0.3, 1.5, 0.2)
+
+    def run():
+        for vector in rays:
+            model.hit_test(position, vector)
+    return {
+        'ray': measure(run, 10, repeat) / len(rays),
+    }
+
+
+def bench_physics(model, repeat):
+    world = model.world
+    step = 1.0 / main.TICKS_PER_SEC
+
+    def run():
+        position, dy = (0, 2, 0), 0
+        for _ in xrange(8):
+            position, dy = main.move_player(world, position, dy, (-1, 0),
+                (0, 0), 0, step)
+
+    # A crowd of players walking in all directions, as the server runs them.
+    count = 256
+    positions = [((i % 16) - 8 + 0.5, 2, (i // 16) - 8 + 0.5)
+        for i in xrange(count)]
+    motions = [main.input_motion(0, (-1, 0), (i * 360.0 / count, 0), 0)[1]
+        for i in xrange(count)]
+
+    def run_batch():
+        main.move_players(world, positions, [0] * count, motions,
+            [False] * count, step)
+    return {
+        'input': measure(run, 100, repeat) / 8,
+        'input_batched': measure(run_batch, 10, repeat) / count,
+    }
+
+
+def bench_protocol(repeat):
+    uuid = '\0' * 16
+    messages = [
+        (main.MSG_PLAYER_POSITION, 1.5, 2.0, -3.25),
+        (main.MSG_INPUT, uuid, 1, -1, 0, 30.0, -10.0, main.INPUT_JUMP),
+    ]
+    packets = [main.encode_message(*msg) for msg in messages]
+
+    def encode():
+        for msg in messages:
+            main.encode_message(*msg)
+
+    def decode():
+        for packet in packets:
+            for _ in main.decode_messages(packet):
+                pass
+    return {
+        'encode': measure(encode, 1000, repeat) / len(messages),
+        'decode': measure(decode, 1000, repeat) / len(packets),
+    }
+
+
+def run_benchmarks():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--workers', type=int, default=0,
+        help='worker processes used to build sectors (default: 0)')
+    parser.add_argument('--output', help='file to write the results to')
+    args = parser.parse_args()
+    main.WORKER_PROCESSES = args.workers
+
+    # Sectors are meshed into an untextured group, since textures can't be
+    # created without a GL context.
+    main.blockAtlas._group = pyglet.graphics.Group()
+
+    started = time.time()
+    model = new_model(args.seed)
+    results = {
+        'generation': bench_generation(args.seed, args.repeat),
+        'sectors': bench_sectors(args.seed, args.repeat),
+        'blocks': bench_blocks(model, args.repeat),
+        'hit_test': bench_hit_test(model, args.repeat),
+        'physics': bench_physics(model, args.repeat),
+        'protocol': bench_protocol(args.repeat),
+    }
+    main.stop_workers()
+    report = {
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'seed': args.seed,
+        'workers': args.workers,
+        'elapsed': time.time() - started,
+        'seconds_per_call': results,
+    }
+    text = json.dumps(report, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text + '\n')
+    else:
+        print text
+
+
+if __name__ == '__main__':
+    run_benchmarks()
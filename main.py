@@ -1,19 +1,37 @@
+import time
+
+# When the game was started, to measure how long it takes to show the world,
+# imports included.
+STARTED = time.time()
+
+import ctypes
+import json
 import math
+import mmap
+import multiprocessing
+import os
 import random
-import time
+import struct
 import thread
+import timeit
 import sys
+import zlib
+import numpy
 import pyglet
+
+# The game has a single window, and no GL context may exist yet when the
+# worker processes are forked, see start_workers().
+pyglet.options['shadow_window'] = False
+
 import pygletreactor
 pygletreactor.install()
 
-import jsonpickle
 
 from twisted.spread import pb
 from twisted.internet import reactor
 from twisted.python import util
 
-from collections import deque
+from collections import deque, OrderedDict
 from pyglet import image
 from pyglet.gl import *
 from pyglet.graphics import TextureGroup
@@ -26,17 +44,65 @@ __builtin__.WINDOW = False
 
 TICKS_PER_SEC = 60
 
+# How many frames are drawn per second, independently of the simulation,
+# which runs TICKS_PER_SEC fixed steps a second whatever the frame rate. None
+# draws frames as fast as possible, see the --uncapped option.
+FRAME_RATE = 60
+
+# The time spent building sectors each frame is halved, down to
+# MIN_QUEUE_BUDGET seconds, while frames take longer than they should, and
+# grows back by as much each frame up to a whole tick while they don't.
+MIN_QUEUE_BUDGET = 0.002
+
 # Size of sectors used to ease block loading.
 SECTOR_SIZE = 16
 
+# Number of sectors shown in each direction around the player's sector,
+# horizontally and vertically. The fog ends and the far plane lies just
+# inside the horizontal distance.
+VIEW_DISTANCE = 6
+VERTICAL_VIEW_DISTANCE = 2
+
+# Sectors further than LOD_DISTANCE sectors from the player are drawn with
+# blocks LOD_SCALE times as large. Once switched, a sector keeps its level of
+# detail until it is a whole sector past LOD_DISTANCE on the other side, so
+# walking back and forth over the boundary doesn't keep rebuilding it. The
+# nearest of them are at least 48 blocks away, well into the fog.
+LOD_DISTANCE = 3
+LOD_SCALE = 2
+
+# Number of sectors along each side of the cube of sectors stored together in
+# one region file.
+REGION_SIZE = 8
+
+# Directory the world is saved to.
+WORLD_PATH = 'world'
+
+# Number of region files kept open, the ones used most recently.
+OPEN_REGIONS = 16
+
+# File the packed texture atlas is kept in between runs, so the block textures
+# don't have to be decoded on every start. It is packed again whenever one of
+# them changes.
+ATLAS_CACHE = 'atlas.cache'
+
+# Number of worker processes generating and meshing sectors in the background.
+# With 0 all of that work is done on the main thread.
+WORKER_PROCESSES = max(1, multiprocessing.cpu_count() - 1)
+
 WALKING_SPEED = 5
-ACTUAL_WALKING_SPEED = WALKING_SPEED
+SLOW_WALKING_SPEED = 2
 FLYING_SPEED = 15
 
-BROADCASTDISTANCE = 100000
+# How far away, in blocks, the server tells players about each other.
+BROADCASTDISTANCE = 96
+
+# How many snapshots of sectors holding blocks the server sends each player
+# per tick. Snapshots of empty sectors are tiny and don't count.
+SNAPSHOTS_PER_TICK = 6
 
 GRAVITY = 20.0
-MAX_JUMP_HEIGHT = 1.0 # About the height of a block.
+MAX_JUMP_HEIGHT = 1.2 # A bit over the height of a block, to jump onto one.
 # To derive the formula for calculating jump speed, first solve
 #    v_t = v_0 + a * t
 # for the time at which you achieve maximum height, where a is the acceleration
@@ -47,7 +113,25 @@ MAX_JUMP_HEIGHT = 1.0 # About the height of a block.
 JUMP_SPEED = math.sqrt(2 * GRAVITY * MAX_JUMP_HEIGHT)
 TERMINAL_VELOCITY = 50
 
-PLAYER_HEIGHT = 2
+# The box a player takes up, relative to its position, which is at eye level.
+# Players collide with blocks and are drawn as this box.
+PLAYER_BOX = ((-0.25, -1.25, -0.25), (0.25, 0.25, 0.25))
+
+# How far inside a block a box has to reach to count as touching it, so that
+# boxes resting against a block don't overlap it.
+COLLISION_EPSILON = 1e-6
+
+# How many of the latest timings of each profiled scope the profiler keeps to
+# work out percentiles from, and how many of the latest timings it keeps for
+# exporting as a trace.
+PROFILE_SAMPLES = 300
+PROFILE_TRACE_EVENTS = 100000
+
+# The perspective projection: vertical field of view in degrees, and the
+# distances to the near and far clipping planes.
+FIELD_OF_VIEW = 65.0
+NEAR_PLANE = 0.1
+FAR_PLANE = 100.0
 
 def cube_vertices(x, y, z, n):
     """ Return the vertices of the cube at position x, y, z with size 2*n.
@@ -63,6 +147,18 @@ def cube_vertices(x, y, z, n):
     ]
 
 
+def box_vertices(low, high):
+    """ Return the vertices of the box between corners `low` and `high`, in
+    the same layout as `cube_vertices()`.
+
+    """
+    vertices = []
+    for corners in FACE_CORNERS:
+        for corner in corners:
+            vertices.extend((low, high)[c][i] for i, c in enumerate(corner))
+    return vertices
+
+
 def tex_coord(x, y, n=1):
     """ Return the bounding vertices of the texture square.
 
@@ -73,6 +169,20 @@ def tex_coord(x, y, n=1):
     return dx, dy, dx + m, dy, dx + m, dy + m, dx, dy + m
 
 
+# Decoded images by filename, see load_image().
+_images = {}
+
+def load_image(filename):
+    """ Return the image in `filename`. Images are only decoded when first
+    needed, and once.
+
+    """
+    img = _images.get(filename)
+    if img is None:
+        img = _images[filename] = image.load(filename)
+    return img
+
+
 def tex_coords(top=(0,0), bottom=(0,0), side=(0,0)):
     """ Return a list of the texture squares for the top, bottom and side.
 
@@ -93,7 +203,14 @@ class TextureGroupManager_BaseTextureGroup(object):
     def __init__(self, filename, name):
         self.name = name
         self.filename = filename
-        self.group = TextureGroup(image.load(filename).get_texture())
+        self._group = None
+
+    # Loaded on first use.
+    @property
+    def group(self):
+        if self._group is None:
+            self._group = TextureGroup(load_image(self.filename).get_texture())
+        return self._group
 
 class TextureGroupManager(object):
     def __init__(self):
@@ -112,14 +229,254 @@ class TextureGroupManager(object):
         return x
 textureGroupManager = TextureGroupManager()
 
+# Packs block textures into the cells of a single texture, so that blocks of
+#   every type can be drawn from one vertex list with one texture bind. The
+#   textures are loaded and packed when the atlas is first used.
+class TextureAtlas(object):
+    def __init__(self, filenames):
+        self.filenames = list(filenames)
+        self._regions = None
+        self._image = None
+        self._group = None
+
+    # Mapping from filename to the (u0, v0, u1, v1) region of the atlas.
+    @property
+    def regions(self):
+        if self._regions is None:
+            self._pack()
+        return self._regions
+
+    # The packed ImageData.
+    @property
+    def image(self):
+        if self._image is None:
+            self._pack()
+        return self._image
+
+    # The cache is the JSON of its sources, size and regions on the first
+    #   line, followed by the raw RGBA data of the atlas.
+    def _sources(self):
+        return [[filename, os.path.getmtime(filename)]
+            for filename in self.filenames]
+
+    def _load_cache(self):
+        try:
+            with open(ATLAS_CACHE, 'rb') as f:
+                header = json.loads(f.readline())
+                data = f.read()
+        except (IOError, ValueError):
+            return False
+        size = header['size']
+        if (header['sources'] != self._sources() or
+                len(data) != size * size * 4):
+            return False
+        self._regions = dict((str(filename), tuple(region))
+            for filename, region in header['regions'].iteritems())
+        self._image = image.ImageData(size, size, 'RGBA', data)
+        return True
+
+    def _save_cache(self):
+        header = {'sources': self._sources(), 'size': self._image.width,
+            'regions': self._regions}
+        try:
+            with open(ATLAS_CACHE, 'wb') as f:
+                f.write(json.dumps(header) + '\n')
+                f.write(self._image.get_data('RGBA', self._image.width * 4))
+        except IOError:
+            pass
+
+    def _pack(self):
+        if self._load_cache():
+            return
+        filenames = self.filenames
+        images = [load_image(filename) for filename in filenames]
+        cell = max(max(img.width, img.height) for img in images)
+        columns = int(math.ceil(math.sqrt(len(images))))
+        size = 1
+        while size < columns * cell:
+            size *= 2
+        pitch = size * 4
+        data = bytearray(pitch * size)
+        # Inset the regions by half a texel so GL_NEAREST never samples the
+        # neighboring cell at the edges of a face.
+        e = 0.5 / size
+        regions = {}
+        for index, (filename, img) in enumerate(zip(filenames, images)):
+            x = (index % columns) * cell
+            y = (index // columns) * cell
+            row_length = img.width * 4
+            rows = img.get_data('RGBA', row_length)
+            for row in xrange(img.height):
+                offset = (y + row) * pitch + x * 4
+                data[offset:offset + row_length] = \
+                    rows[row * row_length:(row + 1) * row_length]
+            regions[filename] = (
+                float(x) / size + e, float(y) / size + e,
+                float(x + img.width) / size - e,
+                float(y + img.height) / size - e)
+        self._regions = regions
+        self._image = image.ImageData(size, size, 'RGBA', str(data))
+        self._save_cache()
+
+    # The TextureGroup of the atlas. Created on first use, as uploading the
+    #   texture needs a GL context.
+    @property
+    def group(self):
+        if self._group is None:
+            texture = self.image.get_texture()
+            glBindTexture(texture.target, texture.id)
+            glTexParameteri(texture.target, GL_TEXTURE_MIN_FILTER, GL_NEAREST)
+            glTexParameteri(texture.target, GL_TEXTURE_MAG_FILTER, GL_NEAREST)
+            self._group = TextureGroup(texture)
+        return self._group
+
+    # Returns the texture coordinates of all 6 faces of a block using the
+    #   given file, in the same layout as tex_coords().
+    def tex_coords(self, filename):
+        u0, v0, u1, v1 = self.regions[filename]
+        return [u0, v0, u1, v0, u1, v1, u0, v1] * 6
+
+blockAtlas = TextureAtlas(["grass.png", "sand.png", "brick.png", "stone.png",
+    "wood.png", "stick.png", "coal.png"])
+
+# Shaders drawing sector meshes. A quad's texture coordinates count blocks
+#   across it, and its color holds the (u0, v0, width, height) region of its
+#   block's texture, which is repeated once per block. That way a merged quad
+#   can cover many blocks even when their texture is a cell of the atlas.
+#   Fog is applied the same way as the fixed function pipeline does.
+TILE_VERTEX_SHADER = """
+#version 120
+varying vec2 tile;
+varying vec4 region;
+varying float fog;
+void main() {
+    vec4 eye = gl_ModelViewMatrix * gl_Vertex;
+    gl_Position = gl_ProjectionMatrix * eye;
+    tile = gl_MultiTexCoord0.xy;
+    region = gl_Color;
+    fog = clamp((gl_Fog.end - abs(eye.z)) * gl_Fog.scale, 0.0, 1.0);
+}
+"""
+TILE_FRAGMENT_SHADER = """
+#version 120
+uniform sampler2D texture;
+varying vec2 tile;
+varying vec4 region;
+varying float fog;
+void main() {
+    vec4 color = texture2D(texture, region.xy + fract(tile) * region.zw);
+    gl_FragColor = vec4(mix(gl_Fog.color.rgb, color.rgb, fog), color.a);
+}
+"""
+
+# Draws the sector meshes of a texture with the tiling shaders, on top of the
+#   group binding that texture. The shaders are compiled on first use, as
+#   that needs a GL context.
+class TileGroup(pyglet.graphics.Group):
+    program = None
+
+    def set_state(self):
+        if TileGroup.program is None:
+            TileGroup.program = compile_program(TILE_VERTEX_SHADER,
+                TILE_FRAGMENT_SHADER)
+        glUseProgram(TileGroup.program)
+
+    def unset_state(self):
+        glUseProgram(0)
+        # The colors holding the regions leave the current color undefined.
+        glColor4f(1, 1, 1, 1)
+
+# The TileGroup drawing over each texture group, by texture group.
+_tile_groups = {}
+
+def tile_group(group):
+    """ Return the `TileGroup` drawing sector meshes with the texture of
+    `group`, the same one each time.
+
+    """
+    tiles = _tile_groups.get(group)
+    if tiles is None:
+        tiles = _tile_groups[group] = TileGroup(parent=group)
+    return tiles
+
+
+def compile_program(vertex_source, fragment_source):
+    """ Compile and link a shader program, returning its name. Raises
+    RuntimeError with the log of the driver if that fails.
+
+    """
+    program = glCreateProgram()
+    for kind, source in ((GL_VERTEX_SHADER, vertex_source),
+            (GL_FRAGMENT_SHADER, fragment_source)):
+        shader = glCreateShader(kind)
+        text = ctypes.c_char_p(source)
+        glShaderSource(shader, 1,
+            ctypes.cast(ctypes.pointer(text),
+                ctypes.POINTER(ctypes.POINTER(GLchar))), None)
+        glCompileShader(shader)
+        status = GLint()
+        glGetShaderiv(shader, GL_COMPILE_STATUS, ctypes.byref(status))
+        if not status.value:
+            log = ctypes.create_string_buffer(4096)
+            glGetShaderInfoLog(shader, len(log), None, log)
+            raise RuntimeError("Shader failed to compile: " + log.value)
+        glAttachShader(program, shader)
+    glLinkProgram(program)
+    status = GLint()
+    glGetProgramiv(program, GL_LINK_STATUS, ctypes.byref(status))
+    if not status.value:
+        log = ctypes.create_string_buffer(4096)
+        glGetProgramInfoLog(program, len(log), None, log)
+        raise RuntimeError("Shader failed to link: " + log.value)
+    return program
+
+
+def draw_vertex_lists(mode, domain, vertex_lists):
+    """ Draw `vertex_lists`, which all belong to `domain`, setting up their
+    attributes once and issuing a single glMultiDrawArrays call. Unlike
+    `Batch.draw_subset()` this doesn't set the state of their group.
+
+    """
+    count = len(vertex_lists)
+    starts = (GLint * count)(*[v.start for v in vertex_lists])
+    sizes = (GLsizei * count)(*[v.count for v in vertex_lists])
+    glPushClientAttrib(GL_CLIENT_VERTEX_ARRAY_BIT)
+    for buffer, attributes in domain.buffer_attributes:
+        buffer.bind()
+        for attribute in attributes:
+            attribute.enable()
+            attribute.set_pointer(attribute.buffer.ptr)
+    glMultiDrawArrays(mode, starts, sizes, count)
+    for buffer, _ in domain.buffer_attributes:
+        buffer.unbind()
+    glPopClientAttrib()
+
 # An instance of Block exists for each available block type.
 # Attributes of Block are shared where it's necessary to optimize.
 class Block(object):
     def __init__(self, texture_file):
-        self.texture_coords = tex_coords()
-        self.baseTextureGroup = textureGroupManager.loadTexture(texture_file)
-        self.group = self.baseTextureGroup.group
         self.texture_file = texture_file
+        if texture_file in blockAtlas.filenames:
+            # Looked up once the atlas is packed.
+            self._texture_coords = None
+            self.baseTextureGroup = None
+        else:
+            # Not part of the atlas (e.g. items dropped into the world), so
+            # the block gets a texture of its own.
+            self._texture_coords = tex_coords()
+            self.baseTextureGroup = textureGroupManager.loadTexture(texture_file)
+
+    @property
+    def texture_coords(self):
+        if self._texture_coords is None:
+            self._texture_coords = blockAtlas.tex_coords(self.texture_file)
+        return self._texture_coords
+
+    @property
+    def group(self):
+        if self.baseTextureGroup is None:
+            return blockAtlas.group
+        return self.baseTextureGroup.group
 
 BLOCKS = {}
 BLOCKS["GRASS"] = Block("grass.png")
@@ -130,6 +487,42 @@ BLOCKS["WOOD"] = Block("wood.png")
 BLOCKS["STICK"] = Block("stick.png")
 BLOCKS["COAL"] = Block("coal.png")
 
+# Assigns every block type a small integer ID, so the world can be stored in
+#   compact integer arrays (see ChunkStore). ID 0 is reserved for air.
+class BlockRegistry(object):
+    def __init__(self, blocks):
+        # Indexed by block ID.
+        self.blocks = [None]
+        self.ids = {}
+        # Register in name order so IDs don't depend on dict ordering.
+        for name in sorted(blocks):
+            self.register(blocks[name])
+
+    # Returns the ID of the given block, assigning it the next free ID if it
+    #   doesn't have one yet.
+    def register(self, block):
+        block_id = self.ids.get(block)
+        if block_id is None:
+            block_id = len(self.blocks)
+            self.ids[block] = block_id
+            self.blocks.append(block)
+        return block_id
+
+    # Returns the blocks in the form the mesher works from, which can be sent
+    #   to worker processes: a list of the distinct TileGroups sector meshes
+    #   are drawn with, and for each block ID a (group index,
+    #   texture_coords) tuple.
+    def mesh_table(self):
+        groups = []
+        table = [None]
+        for block in self.blocks[1:]:
+            group = tile_group(block.group)
+            if group not in groups:
+                groups.append(group)
+            table.append((groups.index(group), block.texture_coords))
+        return groups, table
+blockRegistry = BlockRegistry(BLOCKS)
+
 RECIPES = {}
 RECIPES["stick"] = {"column": [[BLOCKS["WOOD"], BLOCKS["WOOD"]], [], [], []], "result": BLOCKS["STICK"]} # 2 wood blocks stacked on top of each other.
 
@@ -142,6 +535,35 @@ FACES = [
     ( 0, 0,-1),
 ]
 
+# The corners of each face in `FACES`, in the same order (and so with the same
+# winding) as `cube_vertices`. For every axis a corner picks either the low (0)
+# or the high (1) edge of the box the face is cut from, which lets a single
+# description serve both unit faces and merged rectangles of faces.
+FACE_CORNERS = [
+    ((0, 1, 0), (0, 1, 1), (1, 1, 1), (1, 1, 0)),  # top
+    ((0, 0, 0), (1, 0, 0), (1, 0, 1), (0, 0, 1)),  # bottom
+    ((0, 0, 0), (0, 0, 1), (0, 1, 1), (0, 1, 0)),  # left
+    ((1, 0, 1), (1, 0, 0), (1, 1, 0), (1, 1, 1)),  # right
+    ((0, 0, 1), (1, 0, 1), (1, 1, 1), (0, 1, 1)),  # front
+    ((1, 0, 0), (0, 0, 0), (0, 1, 0), (1, 1, 0)),  # back
+]
+
+
+# A sector's connectivity says which of its sides air connects, with bit
+# i * 6 + j set if air connects the side facing FACES[i] with the side facing
+# FACES[j]. See `chunk_connectivity()`.
+ALL_CONNECTED = (1 << 36) - 1
+
+# For each face in `FACES`: the axis of its normal, followed by the two axes
+# spanning its plane.
+FACE_AXES = [(1, 0, 2), (1, 0, 2), (0, 1, 2), (0, 1, 2), (2, 0, 1), (2, 0, 1)]
+
+# For each face in `FACES`: the axes the u and v texture coordinates run along.
+FACE_UV_AXES = [(2, 0), (0, 2), (2, 1), (2, 1), (0, 1), (0, 1)]
+
+# Which corner of the texture square (see `tex_coord`) each face corner uses.
+TEX_CORNERS = [(0, 0), (1, 0), (1, 1), (0, 1)]
+
 
 def normalize(position):
     """ Accepts `position` of arbitrary precision and returns the block
@@ -175,85 +597,541 @@ def sectorize(position):
     """
     x, y, z = normalize(position)
     x, y, z = x / SECTOR_SIZE, y / SECTOR_SIZE, z / SECTOR_SIZE
-    return (x, 0, z)
+    return (x, y, z)
 
 
-class Model(object):
+def sectors_around(sector, pad=VIEW_DISTANCE, vertical_pad=VERTICAL_VIEW_DISTANCE):
+    """ Returns the set of sectors shown when the player is in `sector`: the
+    sectors within `pad` sectors of it horizontally, and `vertical_pad`
+    sectors vertically.
 
-    def __init__(self):
+    """
+    x, y, z = sector
+    sectors = set()
+    for dx in xrange(-pad, pad + 1):
+        for dy in xrange(-vertical_pad, vertical_pad + 1):
+            for dz in xrange(-pad, pad + 1):
+                if dx ** 2 + dz ** 2 > (pad + 1) ** 2:
+                    continue
+                sectors.add((x + dx, y + dy, z + dz))
+    return sectors
 
-        # A Batch is a collection of vertex lists for batched rendering.
-        self.batch = pyglet.graphics.Batch()
 
-        # A mapping from position to the texture of the block at that position.
-        # This defines all the blocks that are currently in the world.
-        self.world = {}
+def sector_detail(sector, center, current=None):
+    """ Returns the scale to draw `sector` at when the player is in sector
+    `center`: 1 for full detail, LOD_SCALE for far away sectors. `current`
+    is the scale the sector is drawn at now, if any.
 
-        # Same mapping as `world` but only contains blocks that are shown.
-        self.shown = {}
+    """
+    distance = math.sqrt(sum((a - b) ** 2 for a, b in zip(sector, center)))
+    if current == LOD_SCALE and distance > LOD_DISTANCE:
+        return LOD_SCALE
+    if current == 1 and distance <= LOD_DISTANCE + 1:
+        return 1
+    return LOD_SCALE if distance > LOD_DISTANCE else 1
 
-        # Mapping from position to a pyglet `VertextList` for all shown blocks.
-        self._shown = {}
 
-        # Mapping from sector to a list of positions inside that sector.
-        self.sectors = {}
+def sectors_needed(shown):
+    """ Returns the set of sectors whose blocks are needed to mesh the
+    sectors in `shown`: those sectors and the ones sharing a side with them.
 
-        # Simple function queue implementation. The queue is populated with
-        # _show_block() and _hide_block() calls
-        self.queue = deque()
+    """
+    needed = set(shown)
+    for x, y, z in shown:
+        for dx, dy, dz in FACES:
+            needed.add((x + dx, y + dy, z + dz))
+    return needed
 
-        self._initialize()
 
-    def _initialize(self):
-        """ Initialize the world by placing all the blocks.
-
-        """
-        n = 80  # 1/2 width and height of world
-        s = 1  # step size
-        y = -5  # initial y height
-        max_depth = 10
-        h = 0
-        while h < max_depth:
-            h += 1
-
-            '''max_aint = 50
-            aint = random.randint(0, max_aint)
-            if aint <= 1: # 1% chance to switch terrain placement height.
-                bint = random.randint(0, 1)
-                cint = random.randint(0, 1)
-                if cint == 0:
-                    y -= bint
-                else:
-                    y += bint'''
-
-            for x in xrange(-n, n + 1, s):
-                for z in xrange(-n, n + 1, s):
-                    # create a layer stone an grass everywhere.                    
-                    rint = random.randint(0, 500)
-                    coal_drop_rate = 2 + h
-                    if rint >= coal_drop_rate:
-                        self.add_block((x, y - h, z), BLOCKS["GRASS"], immediate=False)
-                    elif rint >= coal_drop_rate + 200:
-                        self.add_block((x, y - h, z), BLOCKS["STONE"], immediate=False)
-                    else:
-                        self.add_block((x, y - h, z), BLOCKS["COAL"], immediate=False)
-
-                    if x in (-n, n) or z in (-n, n):
-                        # create outer walls.
-                        for dy in xrange(-2, 3):
-                            self.add_block((x, y + dy, z), BLOCKS["STONE"], immediate=False)
-
-        # generate the hills randomly
-        '''
-        o = n - 10
+def greedy_rectangles(cells):
+    """ Merge a 2d grid of cells into as few rectangles as possible, where each
+    rectangle only covers cells with the same value.
+
+    Parameters
+    ----------
+    cells : list of lists
+        The value of each cell, indexed [a][b]. Cells with a value of 0 are
+        empty and left out. Modified in place.
+
+    Returns
+    -------
+    rectangles : list of tuples
+        Each rectangle as (a, b, width along a, width along b, value).
+
+    """
+    na, nb = len(cells), len(cells[0])
+    rectangles = []
+    for a in xrange(na):
+        row = cells[a]
+        b = 0
+        while b < nb:
+            value = row[b]
+            if not value:
+                b += 1
+                continue
+            # Grow along b first, then along a for as long as the whole strip
+            # still matches.
+            wb = 1
+            while b + wb < nb and row[b + wb] == value:
+                wb += 1
+            strip = [value] * wb
+            wa = 1
+            while a + wa < na and cells[a + wa][b:b + wb] == strip:
+                wa += 1
+            for i in xrange(a + 1, a + wa):
+                cells[i][b:b + wb] = [0] * wb
+            rectangles.append((a, b, wa, wb, value))
+            b += wb
+    return rectangles
+
+
+def downsample(ids, scale):
+    """ Shrink the padded block IDs of a chunk (see `ChunkStore.padded()`)
+    by `scale` along each axis. Each cell of the result is solid if any of
+    the blocks it covers is, and takes the highest of their IDs. A cell of
+    the border is only solid if all the blocks it covers are, so the faces
+    along the edge of the sector are kept wherever the neighboring sector,
+    which may be drawn at full detail, has a gap.
+
+    """
+    n = (ids.shape[0] - 2) // scale
+    inner = ids[1:-1, 1:-1, 1:-1].reshape(n, scale, n, scale, n, scale)
+    out = numpy.zeros((n + 2, n + 2, n + 2), ids.dtype)
+    out[1:-1, 1:-1, 1:-1] = inner.max(axis=(1, 3, 5))
+    # The border holds the touching layer of the neighboring chunks, which
+    # only shrinks along the two axes of its plane.
+    def plane(layer):
+        return layer.reshape(n, scale, n, scale).min(axis=(1, 3))
+    out[0, 1:-1, 1:-1] = plane(ids[0, 1:-1, 1:-1])
+    out[-1, 1:-1, 1:-1] = plane(ids[-1, 1:-1, 1:-1])
+    out[1:-1, 0, 1:-1] = plane(ids[1:-1, 0, 1:-1])
+    out[1:-1, -1, 1:-1] = plane(ids[1:-1, -1, 1:-1])
+    out[1:-1, 1:-1, 0] = plane(ids[1:-1, 1:-1, 0])
+    out[1:-1, 1:-1, -1] = plane(ids[1:-1, 1:-1, -1])
+    return out
+
+
+def build_sector_mesh(chunks, blocks, scale=1):
+    """ Build the vertex data for the given chunks of the world. Only faces
+    that touch air are emitted, and coplanar neighboring faces of the same
+    block type are merged into larger quads.
+
+    Parameters
+    ----------
+    chunks : list of tuples
+        The chunks to mesh, usually the chunks of one sector, as (chunk,
+        block IDs) pairs where the block IDs come from `ChunkStore.padded()`.
+    blocks : list
+        The block table from `BlockRegistry.mesh_table()`.
+    scale : int
+        Build a coarser mesh, as if blocks were `scale` times as large. See
+        `downsample()`.
+
+    Returns
+    -------
+    mesh : dict
+        Mapping from group index to a (vertex_data, texture_data,
+        region_data) tuple of float32 arrays ready to be copied into vertex
+        lists of GL_QUADS, see `TileGroup`. Blocks sharing the texture atlas
+        all end up in the same entry.
+
+    """
+    mesh = {}
+    for chunk, ids in chunks:
+        origin = [c * SECTOR_SIZE for c in chunk]
+        if scale > 1:
+            ids = downsample(ids, scale)
+        s = ids.shape[0] - 2
+        inner = ids[1:-1, 1:-1, 1:-1]
+        for face, (dx, dy, dz) in enumerate(FACES):
+            neighbors = ids[1 + dx:s + 1 + dx, 1 + dy:s + 1 + dy,
+                1 + dz:s + 1 + dz]
+            # The block ID wherever this face of a block touches air.
+            exposed = numpy.where(neighbors == 0, inner, 0)
+            axis, a, b = FACE_AXES[face]
+            # Index the exposed faces as [layer][a][b], where layer is the
+            # block coordinate along the face normal.
+            planes = exposed.transpose(axis, a, b)
+            for layer in numpy.nonzero(planes.any(axis=(1, 2)))[0]:
+                cells = planes[layer].tolist()
+                layer = origin[axis] + int(layer) * scale
+                for ca, cb, wa, wb, block_id in greedy_rectangles(cells):
+                    _add_quad(mesh, blocks[block_id], face, layer,
+                        origin[a] + ca * scale, origin[b] + cb * scale,
+                        wa * scale, wb * scale, scale)
+    for group, data in mesh.items():
+        mesh[group] = tuple(numpy.array(d, numpy.float32) for d in data)
+    return mesh
+
+
+def chunk_connectivity(ids):
+    """ Returns which sides of a chunk are connected through air, as bits of
+    the form described at `ALL_CONNECTED`.
+
+    Parameters
+    ----------
+    ids : numpy array of 3 dimensions
+        The block IDs of the chunk, without padding.
+
+    """
+    air = ids == 0
+    if not air.any():
+        return 0
+    if air.all():
+        return ALL_CONNECTED
+    # Give every air block its own label, then sweep along each axis both
+    # ways, each block taking the highest label before it in its run of air,
+    # until nothing changes. That leaves one label per connected region of
+    # air. Adding the number of solid blocks so far times `n` to the labels
+    # keeps runs from taking labels from the runs before them.
+    n = air.size + 1
+    labels = numpy.where(air, numpy.arange(1, n).reshape(air.shape), 0)
+    sweeps = []
+    for axis in xrange(3):
+        for step in (1, -1):
+            index = [slice(None)] * 3
+            index[axis] = slice(None, None, step)
+            index = tuple(index)
+            sweeps.append((axis, index,
+                numpy.cumsum(~air[index], axis=axis) * n))
+    while True:
+        before = labels
+        for axis, index, run in sweeps:
+            labels = numpy.maximum.accumulate(run + labels[index],
+                axis=axis) - run
+            labels = labels[index] * air
+        if (labels == before).all():
+            break
+    sides = [labels[:, -1, :], labels[:, 0, :], labels[0, :, :],
+        labels[-1, :, :], labels[:, :, -1], labels[:, :, 0]]
+    sides = [set(numpy.unique(side)) - set([0]) for side in sides]
+    connectivity = 0
+    for i in xrange(6):
+        for j in xrange(6):
+            if sides[i] & sides[j]:
+                connectivity |= 1 << (i * 6 + j)
+    return connectivity
+
+
+def _add_quad(mesh, block, face, layer, a, b, wa, wb, scale=1):
+    """ Add the quad covering `wa` by `wb` faces of `block`, starting at (a, b)
+    in the plane of `face` at `layer`, to `mesh`. With a `scale`, the layer
+    is that many blocks thick, and the texture repeats once every `scale`
+    blocks.
+
+    """
+    group, texture_coords = block
+    axis, a_axis, b_axis = FACE_AXES[face]
+    u_axis, v_axis = FACE_UV_AXES[face]
+    low, high = [0, 0, 0], [0, 0, 0]
+    low[axis], high[axis] = layer - 0.5, layer + scale - 0.5
+    low[a_axis], high[a_axis] = a - 0.5, a + wa - 0.5
+    low[b_axis], high[b_axis] = b - 0.5, b + wb - 0.5
+    bounds = (low, high)
+    t = texture_coords[face * 8:face * 8 + 8]
+    region = (t[0], t[1], t[2] - t[0], t[5] - t[1])
+    # Count the blocks across the quad, for the texture to repeat by.
+    du = float(high[u_axis] - low[u_axis]) / scale
+    dv = float(high[v_axis] - low[v_axis]) / scale
+    vertex_data, texture_data, region_data = mesh.setdefault(group,
+        ([], [], []))
+    for (sx, sy, sz), (su, sv) in zip(FACE_CORNERS[face], TEX_CORNERS):
+        vertex_data.extend((bounds[sx][0], bounds[sy][1], bounds[sz][2]))
+        texture_data.extend((du * su, dv * sv))
+        region_data.extend(region)
+
+
+class ChunkStore(object):
+    """ Storage for the blocks of the world. Blocks are kept as IDs from a
+    `BlockRegistry` in uint16 arrays, one for each SECTOR_SIZE cube of the
+    world (a chunk), which are created as blocks are added to them.
+
+    Also implements the part of the dict interface used to access
+    `Model.world`, with (x, y, z) positions as keys and `Block`s as values.
+
+    """
+
+    def __init__(self, registry):
+        self.registry = registry
+
+        # Mapping from chunk to the array of block IDs in that chunk, indexed
+        # [x][y][z] relative to the chunk origin. Chunks that are all air
+        # are left out.
+        self.chunks = {}
+
+        # Number of blocks in the world.
+        self.count = 0
+
+    def get_ids(self, x, y, z):
+        """ Return the IDs of the blocks at many positions at once, given as
+        integer arrays of their coordinates.
+
+        """
+        s = SECTOR_SIZE
+        keys = numpy.stack([x // s, y // s, z // s], axis=-1)
+        ids = numpy.zeros(x.shape, numpy.uint16)
+        for chunk_key in set(map(tuple, keys.reshape(-1, 3).tolist())):
+            chunk = self.chunks.get(chunk_key)
+            if chunk is None:
+                continue
+            mask = (keys == chunk_key).all(axis=-1)
+            ids[mask] = chunk[x[mask] % s, y[mask] % s, z[mask] % s]
+        return ids
+
+    def get_id(self, position):
+        """ Return the ID of the block at `position`, 0 for air.
+
+        """
+        x, y, z = position
+        s = SECTOR_SIZE
+        chunk = self.chunks.get((x // s, y // s, z // s))
+        if chunk is None:
+            return 0
+        return chunk[x % s, y % s, z % s]
+
+    def set_id(self, position, block_id):
+        """ Set the block at `position` to the block with the given ID, 0 to
+        remove it.
+
+        """
+        x, y, z = position
+        s = SECTOR_SIZE
+        key = (x // s, y // s, z // s)
+        chunk = self.chunks.get(key)
+        if chunk is None:
+            if not block_id:
+                return
+            chunk = self.chunks[key] = numpy.zeros((s, s, s), numpy.uint16)
+        index = (x % s, y % s, z % s)
+        self.count += bool(block_id) - bool(chunk[index])
+        chunk[index] = block_id
+
+    def fill(self, origin, ids):
+        """ Copy a dense array of block IDs into the world in one pass,
+        replacing whatever was there before, air included.
+
+        Parameters
+        ----------
+        origin : tuple of len 3
+            The (x, y, z) position of ids[0][0][0].
+        ids : numpy array of 3 dimensions
+            The block IDs, indexed [x][y][z].
+
+        """
+        s = SECTOR_SIZE
+        ox, oy, oz = origin
+        ex, ey, ez = ox + ids.shape[0], oy + ids.shape[1], oz + ids.shape[2]
+        for cx in xrange(ox // s, (ex - 1) // s + 1):
+            x0, x1 = max(ox, cx * s), min(ex, cx * s + s)
+            for cy in xrange(oy // s, (ey - 1) // s + 1):
+                y0, y1 = max(oy, cy * s), min(ey, cy * s + s)
+                for cz in xrange(oz // s, (ez - 1) // s + 1):
+                    z0, z1 = max(oz, cz * s), min(ez, cz * s + s)
+                    part = ids[x0 - ox:x1 - ox, y0 - oy:y1 - oy,
+                        z0 - oz:z1 - oz]
+                    key = (cx, cy, cz)
+                    chunk = self.chunks.get(key)
+                    if chunk is None:
+                        if not part.any():
+                            continue
+                        chunk = self.chunks[key] = numpy.zeros((s, s, s),
+                            numpy.uint16)
+                    target = (slice(x0 - cx * s, x1 - cx * s),
+                        slice(y0 - cy * s, y1 - cy * s),
+                        slice(z0 - cz * s, z1 - cz * s))
+                    self.count += (numpy.count_nonzero(part) -
+                        numpy.count_nonzero(chunk[target]))
+                    chunk[target] = part
+
+    def sector_arrays(self, sector):
+        """ Return the chunks of `sector` as a list of (chunk y, block IDs)
+        pairs: its one chunk, or none if it is all air.
+
+        """
+        ids = self.chunks.get(sector)
+        if ids is None:
+            return []
+        return [(sector[1], ids)]
+
+    def set_sector(self, sector, chunks):
+        """ Add the chunks of `sector`, in the form returned by
+        `sector_arrays()`, replacing the ones it has now.
+
+        """
+        self.remove_sector(sector)
+        x, _, z = sector
+        for y, ids in chunks:
+            self.chunks[(x, y, z)] = ids
+            self.count += numpy.count_nonzero(ids)
+
+    def remove_sector(self, sector):
+        """ Remove the chunk of `sector`, if it has one.
+
+        """
+        ids = self.chunks.pop(sector, None)
+        if ids is not None:
+            self.count -= numpy.count_nonzero(ids)
+
+
+    def padded(self, chunk):
+        """ Return the block IDs of `chunk` surrounded by a one block border
+        holding the touching layer of each of its 6 neighboring chunks.
+
+        """
+        s = SECTOR_SIZE
+        x, y, z = chunk
+        ids = numpy.zeros((s + 2, s + 2, s + 2), numpy.uint16)
+        ids[1:-1, 1:-1, 1:-1] = self.chunks[chunk]
+        get = self.chunks.get
+        n = get((x - 1, y, z))
+        if n is not None:
+            ids[0, 1:-1, 1:-1] = n[-1, :, :]
+        n = get((x + 1, y, z))
+        if n is not None:
+            ids[-1, 1:-1, 1:-1] = n[0, :, :]
+        n = get((x, y - 1, z))
+        if n is not None:
+            ids[1:-1, 0, 1:-1] = n[:, -1, :]
+        n = get((x, y + 1, z))
+        if n is not None:
+            ids[1:-1, -1, 1:-1] = n[:, 0, :]
+        n = get((x, y, z - 1))
+        if n is not None:
+            ids[1:-1, 1:-1, 0] = n[:, :, -1]
+        n = get((x, y, z + 1))
+        if n is not None:
+            ids[1:-1, 1:-1, -1] = n[:, :, 0]
+        return ids
+
+    @staticmethod
+    def buried(ids):
+        """ Returns True if no block in the padded chunk `ids` (see
+        `padded()`) touches air, so it has nothing to draw.
+
+        """
+        return bool(ids[1:-1, 1:-1, 1:-1].all() and
+            ids[0, 1:-1, 1:-1].all() and ids[-1, 1:-1, 1:-1].all() and
+            ids[1:-1, 0, 1:-1].all() and ids[1:-1, -1, 1:-1].all() and
+            ids[1:-1, 1:-1, 0].all() and ids[1:-1, 1:-1, -1].all())
+
+    def memory_report(self):
+        """ Return a dict comparing the memory used by the chunk arrays with
+        an estimate of the memory the same blocks took as a dict keyed by
+        position tuples, plus the per-sector position lists.
+
+        """
+        n = self.count
+        # A dict keeps its table at most 2/3 full, with 3 words per entry.
+        table = 8
+        while table * 2 <= n * 3:
+            table *= 2
+        dict_bytes = (sys.getsizeof({}) + table * 24 +
+            n * sys.getsizeof((0, 0, 0)) + n * 8)
+        chunk_bytes = sum(c.nbytes + sys.getsizeof(c)
+            for c in self.chunks.itervalues())
+        return dict(blocks=n, chunks=len(self.chunks),
+            chunk_bytes=chunk_bytes, dict_bytes=dict_bytes)
+
+    def __contains__(self, position):
+        return self.get_id(position) != 0
+
+    def __getitem__(self, position):
+        block_id = self.get_id(position)
+        if not block_id:
+            raise KeyError(position)
+        return self.registry.blocks[block_id]
+
+    def get(self, position, default=None):
+        return self.registry.blocks[self.get_id(position)] or default
+
+    def __setitem__(self, position, block):
+        self.set_id(position, self.registry.register(block))
+
+    def __delitem__(self, position):
+        if position not in self:
+            raise KeyError(position)
+        self.set_id(position, 0)
+
+    def __len__(self):
+        return self.count
+
+    def __iter__(self):
+        s = SECTOR_SIZE
+        for (cx, cy, cz), chunk in self.chunks.iteritems():
+            for x, y, z in zip(*numpy.nonzero(chunk)):
+                yield (cx * s + int(x), cy * s + int(y), cz * s + int(z))
+
+    iterkeys = __iter__
+
+    def iteritems(self):
+        for position in self:
+            yield position, self[position]
+
+
+def hash_noise(seed, x, y, z):
+    """ Return pseudo-random floats in [0, 1), one for each element of the
+    broadcast integer arrays `x`, `y` and `z`. The value for a position only
+    depends on `seed` and the position itself, so any part of the world can
+    be generated on its own and come out the same.
+
+    """
+    u = numpy.uint64
+    h = ((numpy.asarray(x).astype(u) * u(0x9E3779B1)) ^
+        (numpy.asarray(y).astype(u) * u(0x85EBCA77)) ^
+        (numpy.asarray(z).astype(u) * u(0xC2B2AE3D)) ^ u(seed))
+    h ^= h >> u(15)
+    h *= u(0x2C1B3C6D)
+    h ^= h >> u(12)
+    h *= u(0x297A2D39)
+    h ^= h >> u(15)
+    return (h & u(0xFFFFFF)) / float(0x1000000)
+
+
+class TerrainGenerator(object):
+    """ Seeded, vectorized terrain generation. Builds the block IDs of any
+    rectangular region of the world with numpy, the same seed always giving
+    the same world.
+
+    """
+
+    # 1/2 width and height of the world.
+    SIZE = 80
+
+    # Height of the ground surface, before the heightmap is applied.
+    BASE = -6
+
+    # How far the heightmap moves the surface up or down.
+    AMPLITUDE = 2
+
+    # Number of layers of ground below and including the surface.
+    DEPTH = 10
+
+    # The range of heights the terrain can occupy: from the bottom of the
+    # ground to the top of the highest hill. Sectors outside of it are
+    # empty until the players build there.
+    Y_MIN = BASE - AMPLITUDE - DEPTH + 1
+    Y_MAX = BASE + AMPLITUDE + 6
+
+    def __init__(self, seed, registry):
+        self.seed = seed
+        self.grass = registry.register(BLOCKS["GRASS"])
+        self.stone = registry.register(BLOCKS["STONE"])
+        self.coal = registry.register(BLOCKS["COAL"])
+        self.hills = self._hills(registry)
+
+    def _hills(self, registry):
+        """ Place the hills, returning a list of (x, z, height, radius,
+        block ID) tuples.
+
+        """
+        rng = numpy.random.RandomState(self.seed)
+        o = self.SIZE - 10
+        hills = []
         for _ in xrange(120):
-            a = random.randint(-o, o)  # x position of the hill
-            b = random.randint(-o, o)  # z position of the hill
-            c = -1  # base of the hill
-            h = random.randint(1, 6)  # height of the hill
-            s = random.randint(4, 8)  # 2 * s is the side length of the hill
-            d = 1  # how quickly to taper off the hills
-            t_rand = random.randint(1, 100)
+            a, b = rng.randint(-o, o + 1, 2)  # x, z position of the hill
+            h = rng.randint(1, 7)  # height of the hill
+            s = rng.randint(4, 9)  # 2 * s is the side length of the hill
+            t_rand = rng.randint(1, 101)
             if t_rand < 21:
                 t = BLOCKS["GRASS"]
             elif t_rand < 61:
@@ -262,57 +1140,897 @@ class Model(object):
                 t = BLOCKS["BRICK"]
             else:
                 t = BLOCKS["WOOD"]
+            hills.append((int(a), int(b), int(h), int(s), registry.register(t)))
+        return hills
+
+    def heightmap(self, x, z):
+        """ Return the height of the surface for the integer arrays `x` and
+        `z`, from two octaves of smoothed value noise.
+
+        """
+        n = 0.7 * self._value_noise(x, z, 32, 1) + \
+            0.3 * self._value_noise(x, z, 12, 2)
+        offset = numpy.round(self.AMPLITUDE * (2 * n - 1)).astype(int)
+        return self.BASE + offset
+
+    def _value_noise(self, x, z, scale, octave):
+        """ Noise interpolated between random values on a lattice with the
+        given `scale`.
+
+        """
+        fx, fz = x / float(scale), z / float(scale)
+        ix, iz = numpy.floor(fx).astype(int), numpy.floor(fz).astype(int)
+        tx, tz = fx - ix, fz - iz
+        tx, tz = tx * tx * (3 - 2 * tx), tz * tz * (3 - 2 * tz)
+        def lattice(dx, dz):
+            return hash_noise(self.seed, ix + dx, octave, iz + dz)
+        top = lattice(0, 0) * (1 - tx) + lattice(1, 0) * tx
+        bottom = lattice(0, 1) * (1 - tx) + lattice(1, 1) * tx
+        return top * (1 - tz) + bottom * tz
+
+    def spans(self, y0, height):
+        """ Returns whether any terrain may lie in the `height` layers
+        starting at `y0`.
+
+        """
+        return y0 <= self.Y_MAX and y0 + height > self.Y_MIN
+
+    def generate(self, x0, y0, z0, width, height, depth):
+        """ Generate the box of `width` by `height` by `depth` blocks starting
+        at (x0, y0, z0).
+
+        Returns
+        -------
+        ids : numpy array of 3 dimensions
+            The block IDs of the box, indexed [x][y][z].
+
+        """
+        ids = numpy.zeros((width, height, depth), numpy.uint16)
+        if not self.spans(y0, height):
+            return ids
+        n = self.SIZE
+        x, z = numpy.mgrid[x0:x0 + width, z0:z0 + depth]
+        inside = (abs(x) <= n) & (abs(z) <= n)
+        surface = self.heightmap(x, z)
+        y = numpy.arange(y0, y0 + height)[None, :, None]
+        x3, z3, inside3 = x[:, None, :], z[:, None, :], inside[:, None, :]
+        # How far below the surface each block is, 0 for the surface itself.
+        below = surface[:, None, :] - y
+
+        # A layer of ground everywhere, with coal getting more common the
+        # deeper you dig.
+        ground = inside3 & (below >= 0) & (below < self.DEPTH)
+        ids[ground] = self.grass
+        coal = hash_noise(self.seed, x3, y, z3) < (3 + below) / 501.0
+        ids[ground & coal] = self.coal
+
+        # Outer walls.
+        wall = inside & ((abs(x) == n) | (abs(z) == n))
+        ids[wall[:, None, :] & (below <= 1) & (below >= -3)] = self.stone
+
+        # Hills, resting on the surface and tapering off as they go up.
+        for a, b, h, s, t in self.hills:
+            if (a + s < x0 or a - s >= x0 + width or
+                    b + s < z0 or b - s >= z0 + depth):
+                continue
+            dx, dz = abs(x - a), abs(z - b)
+            layers = numpy.zeros(x.shape, int)
+            for r in xrange(s, s - h, -1):
+                if r < 0:
+                    break
+                layers += ((dx <= r) & (dz <= r) &
+                    (dx ** 2 + dz ** 2 <= (r + 1) ** 2))
+            # Keep the spawn point clear.
+            layers[x ** 2 + z ** 2 < 5 ** 2] = 0
+            hill = (below < 0) & (-below <= layers[:, None, :])
+            ids[hill] = t
+        return ids
+
+
+CHUNK_HEADER = struct.Struct('<i')
+CHUNK_IDS = numpy.dtype('<u2')
+
+
+def encode_chunks(chunks):
+    """ Returns the chunks of a sector, given as (chunk y, block IDs) pairs,
+    as a string: each chunk y as an int32 followed by its block IDs.
+
+    """
+    return ''.join(CHUNK_HEADER.pack(y) + ids.astype(CHUNK_IDS).tostring()
+        for y, ids in chunks)
+
+
+def decode_chunks(data):
+    """ Returns the (chunk y, block IDs) pairs encoded by `encode_chunks()`.
+
+    """
+    s = SECTOR_SIZE
+    size = CHUNK_HEADER.size + s ** 3 * CHUNK_IDS.itemsize
+    chunks = []
+    for offset in xrange(0, len(data), size):
+        y, = CHUNK_HEADER.unpack_from(data, offset)
+        ids = numpy.frombuffer(data, CHUNK_IDS, s ** 3,
+            offset + CHUNK_HEADER.size)
+        chunks.append((y, ids.reshape((s, s, s)).astype(numpy.uint16)))
+    return chunks
+
+
+class RegionFile(object):
+    """ A file holding the blocks of a cube of REGION_SIZE sectors a side.
+
+    The file starts with a header holding an entry for each sector: the
+    offset of its record in the file, the number of chunks in the record and
+    the number of chunks that fit in the space reserved for it. A record is
+    a list of chunks, each a chunk y followed by its block IDs: the chunk of
+    the sector, or none if it is all air. Sectors that outgrow their space
+    are moved to the end of the file.
+
+    Reads go through `mmap`, so only the parts of the file that are used are
+    paged in.
+
+    """
+
+    MAGIC = 'MCRG'
+    VERSION = 2
+    HEADER = struct.Struct('<4sI')
+    ENTRY = struct.Struct('<IHH')
+    CHUNK = CHUNK_HEADER
+    IDS = CHUNK_IDS
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.chunk_size = SECTOR_SIZE ** 3 * self.IDS.itemsize
+        if not os.path.exists(filename):
+            with open(filename, 'wb') as f:
+                f.write(self.HEADER.pack(self.MAGIC, self.VERSION))
+                f.write('\0' * self.ENTRY.size * REGION_SIZE ** 3)
+        self.file = open(filename, 'r+b')
+        magic, version = self.HEADER.unpack(self.file.read(self.HEADER.size))
+        if magic != self.MAGIC or version != self.VERSION:
+            raise IOError('%s is not a region file' % filename)
+        self._map = None
+
+    def _entry(self, sector):
+        """ Return the offset of the header entry of `sector`.
+
+        """
+        x, y, z = sector
+        n = REGION_SIZE
+        index = ((x % n) * n + y % n) * n + z % n
+        return self.HEADER.size + index * self.ENTRY.size
+
+    def read(self, sector):
+        """ Return the chunks of `sector` as a list of (chunk y, block IDs)
+        pairs, or None if the sector was never written.
+
+        """
+        if self._map is None:
+            self._map = mmap.mmap(self.file.fileno(), 0)
+        data = self._map
+        offset, count, _ = self.ENTRY.unpack_from(data, self._entry(sector))
+        if not offset:
+            return None
+        s = SECTOR_SIZE
+        chunks = []
+        for _ in xrange(count):
+            y, = self.CHUNK.unpack_from(data, offset)
+            offset += self.CHUNK.size
+            ids = numpy.frombuffer(data, self.IDS, s ** 3, offset)
+            chunks.append((y, ids.reshape((s, s, s)).astype(numpy.uint16)))
+            offset += self.chunk_size
+        return chunks
+
+    def write(self, sector, chunks):
+        """ Write the chunks of `sector`, given as (chunk y, block IDs) pairs.
+
+        """
+        record = encode_chunks(chunks)
+        entry = self._entry(sector)
+        self.file.seek(entry)
+        offset, _, capacity = self.ENTRY.unpack(
+            self.file.read(self.ENTRY.size))
+        if not offset or len(chunks) > capacity:
+            self.file.seek(0, os.SEEK_END)
+            offset, capacity = self.file.tell(), len(chunks)
+        self.file.seek(offset)
+        self.file.write(record)
+        self.file.seek(entry)
+        self.file.write(self.ENTRY.pack(offset, len(chunks), capacity))
+        self.file.flush()
+        # The file may have grown, so map it again on the next read.
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+
+    def close(self):
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+        self.file.close()
+
+
+class RegionStore(object):
+    """ Saves sectors of the world to region files in a directory, and loads
+    them back.
+
+    """
+
+    def __init__(self, path):
+        self.path = path
+        if not os.path.isdir(path):
+            os.makedirs(path)
+
+        # Mapping from (x, y, z) of a region to its open `RegionFile`, the
+        # one used longest ago first. At most OPEN_REGIONS are kept open.
+        self.regions = OrderedDict()
+
+    def seed(self, default):
+        """ Return the seed the world was generated with, saving `default`
+        as the seed if the world is new.
+
+        """
+        filename = os.path.join(self.path, 'seed')
+        if os.path.exists(filename):
+            with open(filename) as f:
+                return int(f.read())
+        with open(filename, 'w') as f:
+            f.write(str(default))
+        return default
+
+    def _region(self, sector, create):
+        """ Return the `RegionFile` holding `sector`. If the file doesn't
+        exist, it is created when `create` is True and None is returned
+        otherwise.
+
+        """
+        region_key = tuple(a // REGION_SIZE for a in sector)
+        region = self.regions.pop(region_key, None)
+        if region is None:
+            filename = os.path.join(self.path, 'r.%d.%d.%d.mcr' % region_key)
+            if not create and not os.path.exists(filename):
+                return None
+            if len(self.regions) >= OPEN_REGIONS:
+                self.regions.popitem(last=False)[1].close()
+            region = RegionFile(filename)
+        self.regions[region_key] = region
+        return region
+
+    def load(self, sector):
+        """ Return the saved chunks of `sector`, or None if it was never
+        saved. See `RegionFile.read()`.
+
+        """
+        region = self._region(sector, False)
+        if region is None:
+            return None
+        return region.read(sector)
+
+    def save(self, sector, chunks):
+        """ Save the chunks of `sector`. See `RegionFile.write()`.
+
+        """
+        self._region(sector, True).write(sector, chunks)
+
+    def close(self):
+        for region in self.regions.itervalues():
+            region.close()
+        self.regions.clear()
+
+
+def generate_sector_job(generator, sector):
+    """ Generate the blocks of `sector`. Run in a worker process.
+
+    Returns
+    -------
+    origin, ids
+        The arguments for `ChunkStore.fill()`.
+
+    """
+    s = SECTOR_SIZE
+    origin = tuple(a * s for a in sector)
+    return origin, generator.generate(origin[0], origin[1], origin[2], s, s, s)
+
+
+def mesh_sector_job(chunks, blocks, scale):
+    """ Build the mesh of a sector and work out its connectivity. Run in a
+    worker process. See `build_sector_mesh()` and `chunk_connectivity()`.
+
+    """
+    ids = chunks[0][1][1:-1, 1:-1, 1:-1]
+    return build_sector_mesh(chunks, blocks, scale), chunk_connectivity(ids)
+
+
+class CompletedJob(object):
+    """ Stands in for the `AsyncResult` of a job that was run on the main
+    thread, when there are no worker processes.
+
+    """
+
+    def __init__(self, value):
+        self.value = value
+
+    def ready(self):
+        return True
+
+    def wait(self, timeout=None):
+        pass
+
+    def get(self, timeout=None):
+        return self.value
+
+
+class NullScope(object):
+    """ Stands in for a `ProfileScope` while the profiler is disabled.
+
+    """
+
+    def __enter__(self):
+        pass
+
+    def __exit__(self, *exc_info):
+        pass
+
+NULL_SCOPE = NullScope()
+
+
+class ProfileScope(object):
+    """ Times the code in a `with` block for a `Profiler`.
+
+    """
+
+    __slots__ = ('profiler', 'name', 'start')
+
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+
+    def __enter__(self):
+        self.start = timeit.default_timer()
+
+    def __exit__(self, *exc_info):
+        self.profiler.record(self.name, self.start, timeit.default_timer())
+
+
+class Profiler(object):
+    """ Times named scopes of the game, such as the phases of a frame, to
+    show a breakdown of where the time goes and to export a trace of it.
+    While disabled, a scope costs one attribute check.
+
+    Parameters
+    ----------
+    samples : int
+        How many of the latest timings of each scope to keep for the
+        percentiles.
+    trace_events : int
+        How many of the latest timings to keep for the trace.
+
+    """
+
+    def __init__(self, samples=PROFILE_SAMPLES,
+            trace_events=PROFILE_TRACE_EVENTS):
+        self.enabled = False
+        self.samples = samples
+
+        # Mapping from the name of a scope to its latest durations.
+        self.timings = {}
+
+        # The latest (name, start, duration) timings of all scopes, in the
+        # order they finished.
+        self.trace = deque(maxlen=trace_events)
+
+        # Trace timestamps count from here.
+        self.origin = timeit.default_timer()
+
+    def scope(self, name):
+        """ Return a context manager timing the code in its `with` block as
+        the scope `name`.
+
+        """
+        if not self.enabled:
+            return NULL_SCOPE
+        return ProfileScope(self, name)
+
+    def profile(self, name):
+        """ Return a decorator timing each call of the function as the scope
+        `name`.
+
+        """
+        def decorator(func):
+            def wrapper(*args, **kwargs):
+                if not self.enabled:
+                    return func(*args, **kwargs)
+                with ProfileScope(self, name):
+                    return func(*args, **kwargs)
+            wrapper.__name__ = func.__name__
+            wrapper.__doc__ = func.__doc__
+            return wrapper
+        return decorator
+
+    def record(self, name, start, end):
+        """ Record that the scope `name` ran from `start` to `end`, as given
+        by `timeit.default_timer()`.
+
+        """
+        timings = self.timings.get(name)
+        if timings is None:
+            timings = self.timings[name] = deque(maxlen=self.samples)
+        timings.append(end - start)
+        self.trace.append((name, start, end - start))
+
+    def toggle(self):
+        """ Enable the profiler if it is disabled and the other way around.
+        Timings and trace events from before it was last disabled are
+        dropped, as the gap would show up as a spike.
+
+        """
+        self.enabled = not self.enabled
+        if self.enabled:
+            self.timings.clear()
+            self.trace.clear()
+
+    def percentiles(self, percents=(50, 95, 99)):
+        """ Return a list of the name of each scope, in order, with the
+        given percentiles of its latest durations in seconds.
+
+        """
+        return [(name, numpy.percentile(timings, percents))
+            for name, timings in sorted(self.timings.iteritems())]
+
+    def breakdown(self):
+        """ Return a text table of the percentiles of each scope, in
+        milliseconds.
+
+        """
+        lines = ['%-28s %7s %7s %7s' % ('ms', 'p50', 'p95', 'p99')]
+        for name, values in self.percentiles():
+            lines.append('%-28s %7.2f %7.2f %7.2f' % ((name,) +
+                tuple(values * 1000)))
+        return '\n'.join(lines)
+
+    def export_trace(self, path):
+        """ Write the timings kept for the trace to `path` in the Chrome
+        trace event format, to be opened in chrome://tracing or Perfetto.
+
+        """
+        pid = os.getpid()
+        events = [{
+            'name': name, 'cat': name.split('.')[0], 'ph': 'X',
+            'ts': (start - self.origin) * 1e6, 'dur': duration * 1e6,
+            'pid': pid, 'tid': 0,
+        } for name, start, duration in self.trace]
+        with open(path, 'w') as f:
+            json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f)
+
+PROFILER = Profiler()
+
+
+# The pool of worker processes shared by all models, see start_workers().
+_workers = None
+
+def start_workers():
+    """ Return the pool of WORKER_PROCESSES worker processes, starting it
+    if it isn't running yet, or None when there are no worker processes.
+    The game starts it before creating its window, so the workers aren't
+    forked with a GL context.
+
+    """
+    global _workers
+    if _workers is None and WORKER_PROCESSES:
+        _workers = multiprocessing.Pool(WORKER_PROCESSES)
+    return _workers
+
+
+def stop_workers():
+    """ Let the worker processes finish their jobs, and stop them.
+
+    """
+    global _workers
+    if _workers is not None:
+        _workers.close()
+        _workers.join()
+        _workers = None
+
+
+class Frustum(object):
+    """ The volume the camera can see, matching the projection and camera
+    transform `Window.set_3d()` sets up. Used to skip drawing what is out of
+    view.
+
+    """
+
+    def __init__(self, position, rotation, aspect, fov=FIELD_OF_VIEW,
+            near=NEAR_PLANE, far=FAR_PLANE):
+        x, y = rotation
+        m = math.cos(math.radians(y))
+        forward = (math.cos(math.radians(x - 90)) * m, math.sin(math.radians(y)),
+            math.sin(math.radians(x - 90)) * m)
+        right = (math.cos(math.radians(x)), 0.0, math.sin(math.radians(x)))
+        up = (right[1] * forward[2] - right[2] * forward[1],
+            right[2] * forward[0] - right[0] * forward[2],
+            right[0] * forward[1] - right[1] * forward[0])
+        th = math.tan(math.radians(fov) / 2)
+        tw = th * aspect
+        # Each plane as a normal pointing into the frustum and an offset from
+        # the camera, in order: left, right, bottom, top, near and far.
+        planes = [
+            ([f * tw + r for f, r in zip(forward, right)], 0.0),
+            ([f * tw - r for f, r in zip(forward, right)], 0.0),
+            ([f * th + u for f, u in zip(forward, up)], 0.0),
+            ([f * th - u for f, u in zip(forward, up)], 0.0),
+            (forward, -near),
+            ([-f for f in forward], far),
+        ]
+        # Store the planes as (a, b, c, d), with a point (x, y, z) on the
+        # inside when a * x + b * y + c * z + d >= 0.
+        self.planes = []
+        for (a, b, c), d in planes:
+            d -= a * position[0] + b * position[1] + c * position[2]
+            self.planes.append((a, b, c, d))
+
+    def intersects(self, low, high):
+        """ Returns False if the box from corner `low` to corner `high` is
+        certainly out of view, True otherwise.
+
+        """
+        for a, b, c, d in self.planes:
+            # Test the corner of the box furthest along the plane normal.
+            x = high[0] if a > 0 else low[0]
+            y = high[1] if b > 0 else low[1]
+            z = high[2] if c > 0 else low[2]
+            if a * x + b * y + c * z + d < 0:
+                return False
+        return True
+
+
+class Model(object):
+
+    def __init__(self, seed=None, path=None, remote=False):
+
+        # A Batch is a collection of vertex lists for batched rendering.
+        self.batch = pyglet.graphics.Batch()
+
+        # A mapping from position to the block at that position, stored as
+        # arrays of block IDs. This defines all the blocks that are currently
+        # in the world.
+        self.world = ChunkStore(blockRegistry)
+
+        # The set of sectors that are shown.
+        self.shown = set()
+
+        # Mapping from sector to the list of pyglet `VertexList`s making up
+        # the mesh of that sector, one per texture group.
+        self._shown = {}
+
+        # The set of sectors whose blocks have been generated, or loaded.
+        self.generated = set()
+
+        # Mapping from sector to the number of times its blocks have been
+        # edited, used to throw away meshes built from outdated blocks.
+        self.versions = {}
+
+        # Generation and meshing of sectors happens in worker processes, see
+        # `start_workers()`, except for remote models, which don't generate
+        # anything and mesh on the main thread. These map sectors to the jobs
+        # in progress: the `AsyncResult` of generation jobs, and (version,
+        # groups, `AsyncResult`) for meshing.
+        self.pool = None if remote else start_workers()
+        self.generating = {}
+        self.meshing = {}
+
+        # Sectors waiting for themselves or their neighbors to be generated
+        # before they can be meshed.
+        self.waiting = set()
+
+        # Mapping from shown sector to the scale it is drawn at, see
+        # `sector_detail()`.
+        self.detail = {}
+
+        # Shown sectors whose blocks were edited since their mesh was built.
+        # Rebuilt by process_queue(), each at most once however many edits
+        # it had.
+        self.dirty = set()
+
+        # Number of quads in all sector meshes currently in the batch.
+        self.quad_count = 0
+
+        # Mapping from sector to the (low, high) corners of the box around
+        # its mesh.
+        self.bounds = {}
+
+        # Mapping from each vertex domain of the batch holding sector meshes
+        # to the group it is drawn with.
+        self.domain_groups = {}
+
+        # Number of sectors drawn and skipped by the last call to draw(),
+        # either because they were out of view or hidden behind other
+        # sectors.
+        self.drawn_sectors = 0
+        self.culled_sectors = 0
+        self.occluded_sectors = 0
+
+        # Mapping from shown sector to its connectivity, see
+        # `chunk_connectivity()`. Sectors without one yet count as fully
+        # connected.
+        self.connectivity = {}
+
+        # Incremented when the connectivity of a sector changes. The sectors
+        # found by the last visibility search, and the sector and revision it
+        # was made for.
+        self.graph_revision = 0
+        self.visible = None
+        self._visible_key = None
+
+        # The same seed always generates the same world.
+        if seed is None:
+            seed = random.randint(0, 2 ** 31 - 1)
+
+        # When given a `path`, sectors are saved to region files there as
+        # they go out of range and loaded back when they come into range, so
+        # only the sectors around the player are kept in memory.
+        self.regions = None
+        if path is not None:
+            self.regions = RegionStore(path)
+            seed = self.regions.seed(seed)
+        self.seed = seed
+        self.generator = TerrainGenerator(seed, blockRegistry)
+
+        # The set of sectors that were edited since they were loaded.
+        self.modified = set()
+
+        # The sectors to keep in memory, None for all of them.
+        self.keep = None
+
+        # Mapping from key to the sectors kept in memory for it besides
+        # those in `keep`, see `pin()`.
+        self.pins = {}
+
+        # Incremented whenever blocks are added to or removed from the world.
+        self.revision = 0
+
+        # A remote model gets the blocks of its sectors from the server rather
+        # than generating them. Maps each sector to the sequence number of
+        # the last change from the server applied to it.
+        self.remote = remote
+        self.sequences = {}
+
+        # Mapping from sector to the change waiting for it in the queue, True
+        # to show it and False to hide it. Worked through nearest to the
+        # player first, see `_priority()`.
+        self.queue = {}
+
+        # The sector the player is in and the way it looks, which order the
+        # queue, and the queued sectors in reverse order, None until sorted.
+        self.center = None
+        self.sight = None
+        self._order = None
+
+    def _submit(self, func, *args):
+        """ Run `func` in a worker process, returning its `AsyncResult`.
+
+        """
+        if self.pool is None:
+            return CompletedJob(func(*args))
+        return self.pool.apply_async(func, args)
+
+    def ensure_generated(self, sector):
+        """ Generate the blocks of `sector` right away if that hasn't been
+        done yet. Blocks are generated in the background as sectors come into
+        view, so this is only needed before touching blocks elsewhere.
+
+        """
+        if sector not in self.generated:
+            if self.remote:
+                # Has to wait for the server.
+                return
+            if self._load_saved(sector) or self._load_empty(sector):
+                self._notify_waiting(sector)
+                return
+            self.generating.pop(sector, None)
+            origin, ids = generate_sector_job(self.generator, sector)
+            self._add_generated(sector, origin, ids)
+
+    def _add_generated(self, sector, origin, ids):
+        """ Add the generated blocks of `sector` to the world, and go on with
+        the sectors that were waiting for them.
+
+        """
+        self.world.fill(origin, ids)
+        self.generated.add(sector)
+        self.revision += 1
+        self._notify_waiting(sector)
+
+    def apply_snapshot(self, sector, sequence, chunks):
+        """ Replace the blocks of a sector with a snapshot from the server.
+
+        Parameters
+        ----------
+        sector : tuple of len 3
+            The sector the snapshot is of.
+        sequence : int
+            The sequence number of the last block change in the snapshot.
+        chunks : list
+            The chunks of the sector, see `ChunkStore.sector_arrays()`.
+
+        """
+        if not self._wanted(sector):
+            # Went out of range before it arrived.
+            return
+        # A snapshot replacing blocks already loaded changes the faces on the
+        # boundaries of the neighboring sectors as well.
+        if sector in self.generated:
+            stale = sectors_needed([sector])
+        else:
+            stale = set([sector])
+        self.world.set_sector(sector, chunks)
+        self.sequences[sector] = sequence
+        self.generated.add(sector)
+        self.revision += 1
+        for shown in stale & self.shown:
+            self.versions[shown] = self.versions.get(shown, 0) + 1
+            self.waiting.add(shown)
+        self._notify_waiting(sector)
+
+    def apply_delta(self, sequence, position, block_id):
+        """ Apply a block change from the server, unless the sector it is in
+        isn't loaded or already has it.
+
+        Parameters
+        ----------
+        sequence : int
+            The sequence number of the change.
+        position : tuple of len 3
+            The (x, y, z) position of the block.
+        block_id : int
+            The ID of the block now at `position`, 0 if it was removed.
+
+        """
+        sector = sectorize(position)
+        if sector not in self.generated:
+            return
+        if sequence <= self.sequences.get(sector, 0):
+            return
+        self.sequences[sector] = sequence
+        if self.world.get_id(position) == block_id:
+            return
+        if block_id:
+            self.add_block(position, self.world.registry.blocks[block_id])
+        else:
+            self.remove_block(position)
+
+    def _notify_waiting(self, sector):
+        """ Try again to mesh the sectors waiting for `sector` to be
+        generated: itself and its neighbors. Without worker processes, they
+        are queued instead, so that they are meshed within the budget of
+        `process_queue()` rather than all at once.
+
+        """
+        for waiting in sectors_needed([sector]) & self.waiting:
+            self.waiting.discard(waiting)
+            if self.pool is not None:
+                self._show_sector(waiting)
+            elif waiting in self.shown:
+                self._enqueue(waiting, True)
+
+    def _load_saved(self, sector):
+        """ Load the blocks of `sector` from its region file. Returns False if
+        the sector was never saved.
+
+        """
+        if self.regions is None:
+            return False
+        chunks = self.regions.load(sector)
+        if chunks is None:
+            return False
+        self.generating.pop(sector, None)
+        self.world.set_sector(sector, chunks)
+        self.generated.add(sector)
+        self.revision += 1
+        return True
+
+    def _load_empty(self, sector):
+        """ Count `sector` as generated without generating it if the terrain
+        doesn't reach it, as is the case for most sectors above and below
+        the ground. Returns False otherwise.
+
+        """
+        s = SECTOR_SIZE
+        if self.remote or self.generator.spans(sector[1] * s, s):
+            return False
+        self.generating.pop(sector, None)
+        self.generated.add(sector)
+        return True
+
+    def unload_sector(self, sector):
+        """ Drop the blocks of `sector` from memory, first writing them to its
+        region file if they were edited.
+
+        """
+        if sector in self.modified and self.regions is not None:
+            self.regions.save(sector, self.world.sector_arrays(sector))
+        self.modified.discard(sector)
+        self.sequences.pop(sector, None)
+        self.world.remove_sector(sector)
+        self.generated.discard(sector)
+        self.revision += 1
+
+    def save(self):
+        """ Write all edited sectors to their region files.
+
+        """
+        if self.regions is None:
+            return
+        for sector in self.modified:
+            self.regions.save(sector, self.world.sector_arrays(sector))
+        self.modified.clear()
+
+    def close(self):
+        """ Save the world and close its region files.
+
+        """
+        self.save()
+        if self.regions is not None:
+            self.regions.close()
 
-            #t = random.choice([BLOCKS["GRASS"], BLOCKS["SAND"], BLOCKS["BRICK"], BLOCKS["WOOD"]])
-            for y in xrange(c, c + h):
-                for x in xrange(a - s, a + s + 1):
-                    for z in xrange(b - s, b + s + 1):
-                        if (x - a) ** 2 + (z - b) ** 2 > (s + 1) ** 2:
-                            continue
-                        if (x - 0) ** 2 + (z - 0) ** 2 < 5 ** 2:
-                            continue
-                        self.add_block((x, y, z), t, immediate=False)
-                s -= d  # decrement side lenth so hills taper off
-        '''
     def hit_test(self, position, vector, max_distance=8):
         """ Line of sight search from current position. If a block is
         intersected it is returned, along with the block previously in the line
-        of sight. If no block is found, return None, None.
+        of sight and the face of the block that was hit. If no block is found,
+        return None, None, None.
+
+        The blocks along the line are visited one at a time, in order, by
+        stepping to the next block boundary crossed on any axis.
 
         Parameters
         ----------
         position : tuple of len 3
             The (x, y, z) position to check visibility from.
         vector : tuple of len 3
-            The line of sight vector.
+            The line of sight vector, of unit length.
         max_distance : int
             How many blocks away to search for a hit.
 
-        """
-        m = 8
-        x, y, z = position
-        dx, dy, dz = vector
-        previous = None
-        for _ in xrange(max_distance * m):
-            key = normalize((x, y, z))
-            if key != previous and key in self.world:
-                return key, previous
-            previous = key
-            x, y, z = x + dx / m, y + dy / m, z + dz / m
-        return None, None
-
-    def exposed(self, position):
-        """ Returns False is given `position` is surrounded on all 6 sides by
-        blocks, True otherwise.
+        Returns
+        -------
+        block, previous : tuple of len 3
+            The block that was hit and the block in front of the face that
+            was hit, None if the line starts inside `block`.
+        face : tuple of len 3
+            The direction, one of FACES, the hit face points in. None if the
+            line starts inside `block`.
 
         """
-        x, y, z = position
-        for dx, dy, dz in FACES:
-            if (x + dx, y + dy, z + dz) not in self.world:
-                return True
-        return False
-
-    def add_block(self, position, texture, immediate=True):
+        current = list(normalize(position))
+        if tuple(current) in self.world:
+            return tuple(current), None, None
+        step = [0, 0, 0]
+        t_max = [float('inf')] * 3
+        t_delta = [float('inf')] * 3
+        for axis in xrange(3):
+            p, v, c = position[axis], vector[axis], current[axis]
+            # Blocks are centered on integer coordinates, so the block
+            # boundaries lie halfway between them.
+            if v > 0:
+                step[axis] = 1
+                t_max[axis] = (c + 0.5 - p) / v
+                t_delta[axis] = 1.0 / v
+            elif v < 0:
+                step[axis] = -1
+                t_max[axis] = (c - 0.5 - p) / v
+                t_delta[axis] = -1.0 / v
+        while True:
+            axis = t_max.index(min(t_max))
+            if t_max[axis] > max_distance:
+                return None, None, None
+            previous = tuple(current)
+            current[axis] += step[axis]
+            t_max[axis] += t_delta[axis]
+            key = tuple(current)
+            if key in self.world:
+                face = [0, 0, 0]
+                face[axis] = -step[axis]
+                return key, previous, tuple(face)
+
+    def add_block(self, position, texture, immediate=False):
         """ Add a block with the given `texture` and `position` to the world.
 
         Parameters
@@ -323,19 +2041,20 @@ class Model(object):
             The coordinates of the texture squares. Use `tex_coords()` to
             generate.
         immediate : bool
-            Whether or not to draw the block immediately.
+            Whether to rebuild the meshes affected right away, rather than
+            in the next call to `process_queue()`.
 
         """
+        sector = sectorize(position)
+        self.ensure_generated(sector)
         if position in self.world:
-            self.remove_block(position, immediate)
+            self.remove_block(position)
         self.world[position] = texture
-        self.sectors.setdefault(sectorize(position), []).append(position)
-        if immediate:
-            if self.exposed(position):
-                self.show_block(position)
-            self.check_neighbors(position)
+        self.modified.add(sector)
+        self.revision += 1
+        self.refresh_sectors(position, immediate)
 
-    def remove_block(self, position, immediate=True):
+    def remove_block(self, position, immediate=False):
         """ Remove the block at the given `position`.
 
         Parameters
@@ -343,175 +2062,524 @@ class Model(object):
         position : tuple of len 3
             The (x, y, z) position of the block to remove.
         immediate : bool
-            Whether or not to immediately remove block from canvas.
+            Whether to rebuild the meshes affected right away, rather than
+            in the next call to `process_queue()`.
 
         """
+        sector = sectorize(position)
+        self.ensure_generated(sector)
         del self.world[position]
-        self.sectors[sectorize(position)].remove(position)
-        if immediate:
-            if position in self.shown:
-                self.hide_block(position)
-            self.check_neighbors(position)
-
-    def check_neighbors(self, position):
-        """ Check all blocks surrounding `position` and ensure their visual
-        state is current. This means hiding blocks that are not exposed and
-        ensuring that all exposed blocks are shown. Usually used after a block
-        is added or removed.
+        self.modified.add(sector)
+        self.revision += 1
+        self.refresh_sectors(position, immediate)
+
+    def refresh_sectors(self, position, immediate=False):
+        """ Mark the meshes of the shown sectors whose faces may have changed
+        because of a block added or removed at `position` as dirty, or
+        rebuild them right away if `immediate` is True. This is the sector
+        of `position` itself, plus the neighboring sector when `position`
+        lies on a sector boundary. Meshes of these sectors still being built
+        in the background are thrown away either way.
 
         """
         x, y, z = position
+        sectors = set([sectorize(position)])
         for dx, dy, dz in FACES:
-            key = (x + dx, y + dy, z + dz)
-            if key not in self.world:
+            sectors.add(sectorize((x + dx, y + dy, z + dz)))
+        for sector in sectors:
+            self.versions[sector] = self.versions.get(sector, 0) + 1
+            if sector not in self.shown:
                 continue
-            if self.exposed(key):
-                if key not in self.shown:
-                    self.show_block(key)
+            if immediate:
+                self.dirty.discard(sector)
+                self._build_sector(sector)
             else:
-                if key in self.shown:
-                    self.hide_block(key)
+                self.dirty.add(sector)
 
-    def show_block(self, position, immediate=True):
-        """ Show the block at the given `position`. This method assumes the
-        block has already been added with add_block()
+    def _rebuild_dirty(self, deadline=None):
+        """ Rebuild the meshes of dirty sectors until `deadline` (a
+        `time.clock()` value) has passed, but at least one so that edits
+        always show up. With no deadline, rebuilds all of them.
+
+        """
+        while self.dirty:
+            sector = self.dirty.pop()
+            if sector in self.shown:
+                self._build_sector(sector)
+            if deadline is not None and time.clock() > deadline:
+                return
+
+    def show_sector(self, sector, immediate=False):
+        """ Ensure the mesh of the given sector is drawn to the canvas.
 
         Parameters
         ----------
-        position : tuple of len 3
-            The (x, y, z) position of the block to show.
+        sector : tuple of len 3
+            The sector to show.
         immediate : bool
-            Whether or not to show the block immediately.
+            Whether or not to build the mesh immediately.
 
         """
-        texture = self.world[position].texture_coords
-        group = self.world[position].group
-        self.shown[position] = texture
+        self.shown.add(sector)
         if immediate:
-            self._show_block(position, group, texture)
+            self.queue.pop(sector, None)
+            self.ensure_generated(sector)
+            self._build_sector(sector)
         else:
-            self._enqueue(self._show_block, position, group, texture)
+            self._enqueue(sector, True)
 
-    def _show_block(self, position, group, texture):
-        """ Private implementation of the `show_block()` method.
+    def _show_sector(self, sector):
+        """ Private implementation of the `show_sector()` method. Starts the
+        background jobs generating and meshing the sector. The mesh replaces
+        the one currently drawn, if any, once it's done.
 
-        Parameters
-        ----------
-        position : tuple of len 3
-            The (x, y, z) position of the block to show.
-        texture : list of len 3
-            The coordinates of the texture squares. Use `tex_coords()` to
-            generate.
+        """
+        if sector not in self.shown:
+            # Hidden again before the queue got to it.
+            return
+        # Faces on the sector boundary depend on the neighboring sectors, so
+        # they have to be generated before the sector can be meshed.
+        missing = False
+        for needed in sectors_needed([sector]):
+            if (needed in self.generated or self._load_saved(needed) or
+                    self._load_empty(needed)):
+                continue
+            missing = True
+            if needed not in self.generating and not self.remote:
+                self.generating[needed] = self._submit(generate_sector_job,
+                    self.generator, needed)
+        if missing:
+            self.waiting.add(sector)
+            return
+        groups, blocks = self.world.registry.mesh_table()
+        chunks = self._sector_chunks(sector)
+        if not chunks:
+            # Nothing to draw, no need for a job.
+            self.meshing.pop(sector, None)
+            self._upload(sector, groups, {},
+                self._sector_connectivity(sector, chunks))
+            return
+        self.meshing[sector] = (self.versions.get(sector, 0), groups,
+            self._submit(mesh_sector_job, chunks, blocks,
+                self.detail.get(sector, 1)))
+
+    def _build_sector(self, sector):
+        """ Build the mesh of `sector` on the main thread and swap it in for
+        the one currently drawn, if any.
 
         """
-        x, y, z = position
-        vertex_data = cube_vertices(x, y, z, 0.5)
-        texture_data = list(texture)
-        # create vertex list
-        # FIXME Maybe `add_indexed()` should be used instead
-        self._shown[position] = self.batch.add(24, GL_QUADS, group,
-            ('v3f/static', vertex_data),
-            ('t2f/static', texture_data))
+        self.meshing.pop(sector, None)
+        groups, blocks = self.world.registry.mesh_table()
+        chunks = self._sector_chunks(sector)
+        mesh = build_sector_mesh(chunks, blocks, self.detail.get(sector, 1))
+        self._upload(sector, groups, mesh,
+            self._sector_connectivity(sector, chunks))
+
+    def _sector_chunks(self, sector):
+        """ Return the chunks of `sector` in the form `build_sector_mesh()`
+        takes them. A sector is a single chunk, left out when it is empty or
+        buried.
 
-    def hide_block(self, position, immediate=True):
-        """ Hide the block at the given `position`. Hiding does not remove the
-        block from the world.
+        """
+        if sector not in self.world.chunks:
+            return []
+        ids = self.world.padded(sector)
+        if self.world.buried(ids):
+            return []
+        return [(sector, ids)]
+
+    def _sector_connectivity(self, sector, chunks):
+        """ Return the connectivity of `sector`, given its chunks as returned
+        by `_sector_chunks()`.
+
+        """
+        if chunks:
+            return chunk_connectivity(chunks[0][1][1:-1, 1:-1, 1:-1])
+        if sector in self.world.chunks:
+            # Buried.
+            return 0
+        return ALL_CONNECTED
+
+    def _upload(self, sector, groups, mesh, connectivity=ALL_CONNECTED):
+        """ Copy the vertex data of a finished mesh into new vertex lists,
+        replacing the current mesh of `sector`, and record its connectivity.
+
+        """
+        if self.connectivity.get(sector) != connectivity:
+            self.connectivity[sector] = connectivity
+            self.graph_revision += 1
+        vertex_lists = []
+        for group, data in mesh.iteritems():
+            vertex_data, texture_data, region_data = data
+            count = len(vertex_data) / 3
+            # pyglet interleaves static attributes in a single buffer, which
+            # rules out copying each array in one go, so use dynamic ones.
+            # They are still only written once.
+            vertex_list = self.batch.add(count, GL_QUADS, groups[group],
+                'v3f/dynamic', 't2f/dynamic', 'c4f/dynamic')
+            ctypes.memmove(vertex_list.vertices, vertex_data.ctypes.data,
+                vertex_data.nbytes)
+            ctypes.memmove(vertex_list.tex_coords, texture_data.ctypes.data,
+                texture_data.nbytes)
+            ctypes.memmove(vertex_list.colors, region_data.ctypes.data,
+                region_data.nbytes)
+            self.domain_groups[vertex_list.domain] = groups[group]
+            vertex_lists.append(vertex_list)
+            self.quad_count += count / 4
+        self._delete_mesh(sector)
+        self._shown[sector] = vertex_lists
+        if vertex_lists:
+            vertices = numpy.concatenate([v[0] for v in mesh.itervalues()])
+            vertices = vertices.reshape(-1, 3)
+            self.bounds[sector] = (tuple(vertices.min(axis=0)),
+                tuple(vertices.max(axis=0)))
+
+    def _collect_jobs(self, deadline=None):
+        """ Add the results of finished background jobs to the world: blocks
+        of generated sectors, and meshes, which are uploaded if they are
+        still current. Stops once `deadline` (a `time.clock()` value) has
+        passed. With no deadline, waits for all the jobs in progress.
+
+        """
+        while self.generating or self.meshing:
+            if deadline is not None and time.clock() > deadline:
+                return
+            done = False
+            for sector, result in self.generating.items():
+                if deadline is None:
+                    result.wait()
+                elif not result.ready():
+                    continue
+                del self.generating[sector]
+                # Skip sectors that went out of range in the meantime.
+                if self._wanted(sector) and sector not in self.generated:
+                    origin, ids = result.get()
+                    self._add_generated(sector, origin, ids)
+                done = True
+                break
+            if done:
+                continue
+            for sector, (version, groups, result) in self.meshing.items():
+                if deadline is None:
+                    result.wait()
+                elif not result.ready():
+                    continue
+                del self.meshing[sector]
+                if (sector in self.shown and
+                        version == self.versions.get(sector, 0)):
+                    mesh, connectivity = result.get()
+                    self._upload(sector, groups, mesh, connectivity)
+                done = True
+                break
+            if not done:
+                return
+
+    def hide_sector(self, sector, immediate=False):
+        """ Ensure the mesh of the given sector is removed from the canvas.
 
         Parameters
         ----------
-        position : tuple of len 3
-            The (x, y, z) position of the block to hide.
+        sector : tuple of len 3
+            The sector to hide.
         immediate : bool
-            Whether or not to immediately remove the block from the canvas.
+            Whether or not to remove the mesh immediately.
 
         """
-        self.shown.pop(position)
+        self.shown.discard(sector)
         if immediate:
-            self._hide_block(position)
+            self.queue.pop(sector, None)
+            self._hide_sector(sector)
         else:
-            self._enqueue(self._hide_block, position)
+            self._enqueue(sector, False)
 
-    def _hide_block(self, position):
-        """ Private implementation of the 'hide_block()` method.
+    def _hide_sector(self, sector):
+        """ Private implementation of the `hide_sector()` method.
 
         """
-        self._shown.pop(position).delete()
+        if sector in self.shown:
+            # Shown again before the queue got to it.
+            return
+        self._delete_mesh(sector)
+        self.detail.pop(sector, None)
+        if self.connectivity.pop(sector, None) is not None:
+            self.graph_revision += 1
 
-    def show_sector(self, sector):
-        """ Ensure all blocks in the given sector that should be shown are
-        drawn to the canvas.
+    def _delete_mesh(self, sector):
+        """ Delete the vertex lists making up the mesh of `sector`.
 
         """
-        for position in self.sectors.get(sector, []):
-            if position not in self.shown and self.exposed(position):
-                self.show_block(position, False)
+        self.bounds.pop(sector, None)
+        for vertex_list in self._shown.pop(sector, []):
+            self.quad_count -= vertex_list.get_size() / 4
+            vertex_list.delete()
+
+    def find_visible(self, origin):
+        """ Return the set of shown sectors that can be seen from sector
+        `origin`, found with a flood fill through the sides of sectors that
+        air connects. The fill never turns back in a direction it already
+        went the opposite way, so it doesn't reach sectors only seen through
+        solid ground. The result is kept until `origin` or the connectivity
+        of a sector changes.
 
-    def hide_sector(self, sector):
-        """ Ensure all blocks in the given sector that should be hidden are
-        removed from the canvas.
+        """
+        key = (origin, self.graph_revision)
+        if key == self._visible_key:
+            return self.visible
+        visible = set([origin])
+        # Entries are (sector, face it was entered through, bits of the
+        # faces the fill went out of so far).
+        queue = deque([(origin, None, 0)])
+        while queue:
+            sector, entered, went = queue.popleft()
+            connectivity = self.connectivity.get(sector, ALL_CONNECTED)
+            x, y, z = sector
+            for face, (dx, dy, dz) in enumerate(FACES):
+                # Going back the way the fill came can't find anything more.
+                if went & (1 << (face ^ 1)):
+                    continue
+                if (entered is not None and
+                        not connectivity & (1 << (entered * 6 + face))):
+                    continue
+                neighbor = (x + dx, y + dy, z + dz)
+                if neighbor in visible or neighbor not in self.shown:
+                    continue
+                visible.add(neighbor)
+                queue.append((neighbor, face ^ 1, went | (1 << face)))
+        self.visible = visible
+        self._visible_key = key
+        return visible
+
+    def draw(self, frustum=None, origin=None):
+        """ Draw the meshes of the shown sectors, skipping those that are
+        entirely outside of `frustum`, or that can't be seen from sector
+        `origin`.
+
+        Parameters
+        ----------
+        frustum : Frustum
+            What the camera can see. Everything is drawn if not given.
+        origin : tuple of len 3
+            The sector the camera is in, see `find_visible()`.
 
         """
-        for position in self.sectors.get(sector, []):
-            if position in self.shown:
-                self.hide_block(position, False)
+        # The visible vertex lists, by domain.
+        visible = {}
+        self.drawn_sectors = self.culled_sectors = self.occluded_sectors = 0
+        reachable = self.find_visible(origin) if origin is not None else None
+        for sector, vertex_lists in self._shown.iteritems():
+            if not vertex_lists:
+                continue
+            if reachable is not None and sector not in reachable:
+                self.occluded_sectors += 1
+            elif frustum is None or frustum.intersects(*self.bounds[sector]):
+                for vertex_list in vertex_lists:
+                    visible.setdefault(vertex_list.domain, []).append(
+                        vertex_list)
+                self.drawn_sectors += 1
+            else:
+                self.culled_sectors += 1
+        for domain, vertex_lists in visible.iteritems():
+            group = self.domain_groups[domain]
+            group.set_state_recursive()
+            draw_vertex_lists(GL_QUADS, domain, vertex_lists)
+            group.unset_state_recursive()
 
     def change_sectors(self, before, after):
         """ Move from sector `before` to sector `after`. A sector is a
-        contiguous x, y sub-region of world. Sectors are used to speed up
-        world rendering.
-
-        """
-        before_set = set()
-        after_set = set()
-        pad = 4
-        for dx in xrange(-pad, pad + 1):
-            for dy in [0]:  # xrange(-pad, pad + 1):
-                for dz in xrange(-pad, pad + 1):
-                    if dx ** 2 + dy ** 2 + dz ** 2 > (pad + 1) ** 2:
-                        continue
-                    if before:
-                        x, y, z = before
-                        before_set.add((x + dx, y + dy, z + dz))
-                    if after:
-                        x, y, z = after
-                        after_set.add((x + dx, y + dy, z + dz))
+        SECTOR_SIZE cube of the world. Sectors are used to speed up world
+        rendering.
+
+        """
+        before_set = sectors_around(before) if before else set()
+        after_set = sectors_around(after) if after else set()
         show = after_set - before_set
         hide = before_set - after_set
-        for sector in show:
-            self.show_sector(sector)
+        self.center = after
+        self._order = None
         for sector in hide:
             self.hide_sector(sector)
+        for sector in show:
+            self.show_sector(sector)
+        # Sectors that stay in view, or come back into view before the queue
+        # hid them, may have moved to another level of detail, and need a new
+        # mesh.
+        for sector in after_set:
+            current = self.detail.get(sector)
+            detail = sector_detail(sector, after, current)
+            if detail != current:
+                self.detail[sector] = detail
+                if current is not None:
+                    self.versions[sector] = self.versions.get(sector, 0) + 1
+                    self._enqueue(sector, True)
+        if (self.regions is not None or self.remote) and after:
+            # Keep the shown sectors and their neighbors, which are needed to
+            # mesh them, and unload everything else.
+            self.keep = sectors_needed(after_set)
+            self._unload_unwanted(list(self.generated))
+
+    def _wanted(self, sector):
+        """ Returns whether `sector` is to be kept in memory.
 
-    def _enqueue(self, func, *args):
-        """ Add `func` to the internal queue.
+        """
+        return (self.keep is None or sector in self.keep or
+            any(sector in pinned for pinned in self.pins.itervalues()))
+
+    def _unload_unwanted(self, sectors):
+        """ Unload the sectors of `sectors` that are loaded but no longer
+        wanted.
 
         """
-        self.queue.append((func, args))
+        for sector in sectors:
+            if sector in self.generated and not self._wanted(sector):
+                self.unload_sector(sector)
+
+    def pin(self, key, sectors):
+        """ Load the given sectors now, and keep them in memory wherever the
+        player goes, until `key` pins other sectors or is unpinned. The
+        server pins the sectors around the players it simulates.
+
+        """
+        before = self.pins.get(key, set())
+        self.pins[key] = set(sectors)
+        for sector in self.pins[key]:
+            self.ensure_generated(sector)
+        self._unload_unwanted(before - self.pins[key])
+
+    def unpin(self, key):
+        """ Stop keeping the sectors pinned for `key` in memory.
+
+        """
+        self._unload_unwanted(self.pins.pop(key, ()))
+
+    def sector_snapshot(self, sector):
+        """ Return the chunks of `sector`, see `ChunkStore.sector_arrays()`,
+        loading or generating it if needed. A sector that isn't wanted is
+        read or generated without adding it to the world, which would only
+        unload it again.
+
+        """
+        if sector in self.generated:
+            return self.world.sector_arrays(sector)
+        if self._wanted(sector):
+            self.ensure_generated(sector)
+            return self.world.sector_arrays(sector)
+        if self.regions is not None:
+            chunks = self.regions.load(sector)
+            if chunks is not None:
+                return chunks
+        s = SECTOR_SIZE
+        if not self.generator.spans(sector[1] * s, s):
+            return []
+        _, ids = generate_sector_job(self.generator, sector)
+        return [(sector[1], ids)] if ids.any() else []
+
+    def _enqueue(self, sector, show):
+        """ Queue showing `sector` if `show` is True, or hiding it. Showing
+        and hiding a sector again before the queue gets to it cancel out,
+        when that leaves it as it is drawn now.
+
+        """
+        pending = self.queue.pop(sector, None)
+        self._order = None
+        if pending is not None and pending != show:
+            if show and sector in self._shown:
+                # Its mesh is still drawn.
+                return
+            if (not show and sector not in self._shown and
+                    sector not in self.meshing):
+                # Nothing was drawn yet, nor will be at the detail it was
+                # queued with.
+                self.detail.pop(sector, None)
+                return
+        self.queue[sector] = show
+
+    def _priority(self, sector):
+        """ Return the key ordering `sector` in the queue: hiding goes first,
+        as it is quick and frees memory, then showing the nearest sectors,
+        with those the player looks towards counting as up to half as far
+        and those behind up to half again as far.
+
+        """
+        if not self.queue[sector] or self.center is None:
+            return -1.0
+        dx, dy, dz = [a - b for a, b in zip(sector, self.center)]
+        distance = math.sqrt(dx * dx + dy * dy + dz * dz)
+        if not distance or self.sight is None:
+            return distance
+        sx, sy, sz = self.sight
+        facing = (dx * sx + dy * sy + dz * sz) / distance
+        return distance * (1.0 - 0.5 * facing)
 
     def _dequeue(self):
-        """ Pop the top function from the internal queue and call it.
+        """ Show or hide the first sector in the queue.
 
         """
-        func, args = self.queue.popleft()
-        func(*args)
+        if self._order is None:
+            self._order = sorted(self.queue, key=self._priority, reverse=True)
+        # Sectors taken out of the queue since it was sorted are skipped.
+        sector = self._order.pop()
+        while sector not in self.queue:
+            sector = self._order.pop()
+        if self.queue.pop(sector):
+            self._show_sector(sector)
+        else:
+            self._hide_sector(sector)
 
-    def process_queue(self):
-        """ Process the entire queue while taking periodic breaks. This allows
-        the game loop to run smoothly. The queue contains calls to
-        _show_block() and _hide_block() so this method should be called if
-        add_block() or remove_block() was called with immediate=False
+    def look(self, vector):
+        """ Tell the model the sight vector of the player, so the queue
+        shows the sectors it looks towards first.
 
         """
-        start = time.clock()
-        while self.queue and time.clock() - start < 1.0 / TICKS_PER_SEC:
+        if (self.sight is None or
+                sum(a * b for a, b in zip(vector, self.sight)) < 0.95):
+            self.sight = vector
+            self._order = None
+
+    def load_around(self, center, pad=1):
+        """ Show the sectors within `pad` sectors of sector `center` right
+        away, ahead of the rest of the queue, so the player isn't left
+        floating in nothing after being moved somewhere new.
+
+        """
+        nearby = sectors_around(center, pad, pad) & self.shown
+        for needed in sectors_needed(nearby):
+            self.ensure_generated(needed)
+        for sector in nearby:
+            if self.queue.get(sector) and sector in self.generated:
+                self.show_sector(sector, immediate=True)
+
+    def loading(self):
+        """ Returns whether sectors are still waiting to be shown or hidden
+        or for their background jobs.
+
+        """
+        return bool(self.queue or self.generating or self.meshing)
+
+    def process_queue(self, budget=1.0 / TICKS_PER_SEC):
+        """ Process the queue for up to `budget` seconds, taking a break
+        until the next call after that. This allows the game loop to run
+        smoothly. Sectors are shown and hidden by the queue after
+        show_sector() or hide_sector() were called with immediate=False.
+        Also rebuilds the meshes of edited sectors and collects the results
+        of finished background jobs.
+
+        """
+        deadline = time.clock() + budget
+        self._rebuild_dirty(deadline)
+        self._collect_jobs(deadline)
+        while self.queue and time.clock() < deadline:
             self._dequeue()
 
     def process_entire_queue(self):
-        """ Process the entire queue with no breaks.
+        """ Process the entire queue with no breaks, waiting for all the
+        background jobs it starts to finish.
 
         """
-        while self.queue:
-            self._dequeue()
+        self._rebuild_dirty()
+        while self.queue or self.generating or self.meshing:
+            while self.queue:
+                self._dequeue()
+            self._collect_jobs()
 
 
 
@@ -532,9 +2600,15 @@ class WorldItems(object):
         # Mapping from position to a pyglet `VertextList` for all shown blocks.
         self._shown = {}
 
-        # Mapping from sector to a list of positions inside that sector.
+        # Mapping from sector to the set of positions inside that sector.
         self.sectors = {}
 
+        # Mapping from position to the faces of the block at that position
+        # that touch air, with bit i set for FACES[i]. Kept up to date as
+        # blocks are added and removed, so showing and hiding blocks never
+        # has to look at their neighbors.
+        self.exposure = {}
+
         # Simple function queue implementation. The queue is populated with
         # _show_block() and _hide_block() calls
         self.queue = deque()
@@ -576,11 +2650,7 @@ class WorldItems(object):
         blocks, True otherwise.
 
         """
-        x, y, z = position
-        for dx, dy, dz in FACES:
-            if (x + dx, y + dy, z + dz) not in self.world:
-                return True
-        return False
+        return self.exposure.get(position, 0) != 0
 
     def add_block(self, position, texture, immediate=True):
         """ Add a block with the given `texture` and `position` to the world.
@@ -599,7 +2669,17 @@ class WorldItems(object):
         if position in self.world:
             self.remove_block(position, immediate)
         self.world[position] = texture
-        self.sectors.setdefault(sectorize(position), []).append(position)
+        self.sectors.setdefault(sectorize(position), set()).add(position)
+        # The new block covers the faces of its neighbors touching it.
+        x, y, z = position
+        exposure = 0
+        for face, (dx, dy, dz) in enumerate(FACES):
+            key = (x + dx, y + dy, z + dz)
+            if key in self.exposure:
+                self.exposure[key] &= ~(1 << (face ^ 1))
+            else:
+                exposure |= 1 << face
+        self.exposure[position] = exposure
         if immediate:
             if self.exposed(position):
                 self.show_block(position)
@@ -617,7 +2697,13 @@ class WorldItems(object):
 
         """
         del self.world[position]
-        self.sectors[sectorize(position)].remove(position)
+        self.sectors[sectorize(position)].discard(position)
+        del self.exposure[position]
+        x, y, z = position
+        for face, (dx, dy, dz) in enumerate(FACES):
+            key = (x + dx, y + dy, z + dz)
+            if key in self.exposure:
+                self.exposure[key] |= 1 << (face ^ 1)
         if immediate:
             if position in self.shown:
                 self.hide_block(position)
@@ -636,8 +2722,10 @@ class WorldItems(object):
             if key not in self.world:
                 continue
             if self.exposed(key):
-                if key not in self.shown:
-                    self.show_block(key)
+                if key in self.shown:
+                    # The face it shares with `position` came or went.
+                    self.hide_block(key)
+                self.show_block(key)
             else:
                 if key in self.shown:
                     self.hide_block(key)
@@ -656,13 +2744,14 @@ class WorldItems(object):
         """
         texture = self.world[position].texture_coords
         group = self.world[position].group
+        exposure = self.exposure[position]
         self.shown[position] = texture
         if immediate:
-            self._show_block(position, group, texture)
+            self._show_block(position, group, texture, exposure)
         else:
-            self._enqueue(self._show_block, position, group, texture)
+            self._enqueue(self._show_block, position, group, texture, exposure)
 
-    def _show_block(self, position, group, texture):
+    def _show_block(self, position, group, texture, exposure):
         """ Private implementation of the `show_block()` method.
 
         Parameters
@@ -672,14 +2761,20 @@ class WorldItems(object):
         texture : list of len 3
             The coordinates of the texture squares. Use `tex_coords()` to
             generate.
+        exposure : int
+            The faces to draw, with bit i set for FACES[i].
 
         """
         x, y, z = position
-        vertex_data = cube_vertices(x, y, z, 0.1)
-        texture_data = list(texture)
+        vertices = cube_vertices(x, y, z, 0.1)
+        vertex_data, texture_data = [], []
+        for face in xrange(len(FACES)):
+            if exposure & (1 << face):
+                vertex_data.extend(vertices[face * 12:face * 12 + 12])
+                texture_data.extend(texture[face * 8:face * 8 + 8])
         # create vertex list
         # FIXME Maybe `add_indexed()` should be used instead
-        self._shown[position] = self.batch.add(24, GL_QUADS, group,
+        self._shown[position] = self.batch.add(len(vertex_data) // 3, GL_QUADS, group,
             ('v3f/static', vertex_data),
             ('t2f/static', texture_data))
 
@@ -727,24 +2822,12 @@ class WorldItems(object):
 
     def change_sectors(self, before, after):
         """ Move from sector `before` to sector `after`. A sector is a
-        contiguous x, y sub-region of world. Sectors are used to speed up
-        world rendering.
-
-        """
-        before_set = set()
-        after_set = set()
-        pad = 4
-        for dx in xrange(-pad, pad + 1):
-            for dy in [0]:  # xrange(-pad, pad + 1):
-                for dz in xrange(-pad, pad + 1):
-                    if dx ** 2 + dy ** 2 + dz ** 2 > (pad + 1) ** 2:
-                        continue
-                    if before:
-                        x, y, z = before
-                        before_set.add((x + dx, y + dy, z + dz))
-                    if after:
-                        x, y, z = after
-                        after_set.add((x + dx, y + dy, z + dz))
+        SECTOR_SIZE cube of the world. Sectors are used to speed up world
+        rendering.
+
+        """
+        before_set = sectors_around(before) if before else set()
+        after_set = sectors_around(after) if after else set()
         show = after_set - before_set
         hide = before_set - after_set
         for sector in show:
@@ -765,7 +2848,7 @@ class WorldItems(object):
         func, args = self.queue.popleft()
         func(*args)
 
-    def process_queue(self):
+    def process_queue(self, budget=1.0 / TICKS_PER_SEC):
         # Check to see if world item is in range of the player.
         #pos_rounded = (int(round(WINDOW.position[0])), int(round(WINDOW.position[1])), int(round(WINDOW.position[2])))
         #print str(pos_rounded)
@@ -782,14 +2865,15 @@ class WorldItems(object):
         #    WINDOW.player.inventory.add(item)
         #    self.remove_block(WINDOW.position)
 
-        """ Process the entire queue while taking periodic breaks. This allows
-        the game loop to run smoothly. The queue contains calls to
-        _show_block() and _hide_block() so this method should be called if
-        add_block() or remove_block() was called with immediate=False
+        """ Process the queue for up to `budget` seconds, taking a break until
+        the next call after that. This allows the game loop to run smoothly.
+        The queue contains calls to _show_block() and _hide_block() so this
+        method should be called if add_block() or remove_block() was called
+        with immediate=False
 
         """
         start = time.clock()
-        while self.queue and time.clock() - start < 1.0 / TICKS_PER_SEC:
+        while self.queue and time.clock() - start < budget:
             self._dequeue()
 
     def process_entire_queue(self):
@@ -806,7 +2890,7 @@ class MenuItem(object):
         self.image_file = image_file
         self.pos_x = pos_x
         self.pos_y = pos_y
-        item_image = pyglet.image.load(image_file)
+        item_image = load_image(image_file)
         item = pyglet.sprite.Sprite(item_image, x=pos_x, y=pos_y)
         window.drawregister.add(item.draw)
         self.item_draw = item.draw
@@ -906,8 +2990,7 @@ class InventoryItem(object):
         if(blk == None):
             BLOCKS[self.name] = Block(self.ui_texture)
             BLOCKS[self.name].inventory_item = self
-        vector = WINDOW.get_sight_vector()
-        block, previous = WINDOW.model.hit_test(WINDOW.position, vector)
+        block, previous, _ = WINDOW.get_target()
         if(previous):
             WINDOW.world_items.add_block(previous, blk)
             WINDOW.player.inventory.remove(self)
@@ -927,7 +3010,7 @@ class InventoryItem_Block(InventoryItem):
     def use(self, params):
         # Place the block
         if(self.qty > 0):
-            WINDOW.model.add_block(params, self.worldblock)
+            WINDOW.edit_block(params, self.worldblock)
             self.qty -= 1
             if self.qty <= 0:
                 WINDOW.player.inventory.remove(self)
@@ -968,7 +3051,7 @@ class InventoryItem_MultiTool(InventoryItem):
         item = getInventoryItemBlockFromWorldBlockPosition(params)
         if(item != False):
             WINDOW.player.inventory.add(item)
-            WINDOW.model.remove_block(params)
+            WINDOW.edit_block(params, None)
 
 class InventoryItem_AssemblerTool(InventoryItem):
     def __init__(self, name="AssemblerTool"):
@@ -995,7 +3078,7 @@ class InventoryItem_AssemblerTool(InventoryItem):
             if success == True:
                 # This must be the recipe -- make it by destroying the input blocks, and creating the output item
                 for i in all_pos:
-                    WINDOW.model.remove_block(i)
+                    WINDOW.edit_block(i, None)
                 ###### getInventoryItemBlockFromWorldBlockPosition(params)
                 WINDOW.world_items.add_block(params, v["result"])
                 return
@@ -1042,8 +3125,7 @@ class Player(object):
         self.selected = self.inventory.findNewSelected()
         self.window = window
     def pickup(self):
-        vector = self.window.get_sight_vector()
-        block, previous = self.window.model.hit_test(self.window.position, vector)
+        block, previous, _ = self.window.get_target()
         try:
             item = getInventoryItemBlockFromWorldItemPosition(previous).inventory_item
         except:
@@ -1052,139 +3134,396 @@ class Player(object):
             self.window.player.inventory.add(item)
             self.window.world_items.remove_block(previous)
 
-# Represents any player which is not the current player.
+# Bits of the flags of a player's input.
+INPUT_FLYING = 1
+INPUT_JUMP = 2
+INPUT_SLOW = 4
+
+
+def motion_vector(strafe, rotation, flying):
+    """ Returns the motion vector indicating the velocity of a player.
+
+    Parameters
+    ----------
+    strafe : sequence of len 2
+        The strafing movement of the player, see `Window.strafe`.
+    rotation : tuple of len 2
+        The rotation of the player, see `Window.rotation`.
+    flying : bool
+        Whether the player is flying.
+
+    Returns
+    -------
+    vector : tuple of len 3
+        Tuple containing the velocity in x, y, and z respectively.
+
+    """
+    if any(strafe):
+        x, y = rotation
+        strafe_angle = math.degrees(math.atan2(*strafe))
+        y_angle = math.radians(y)
+        x_angle = math.radians(x + strafe_angle)
+        if flying:
+            m = math.cos(y_angle)
+            dy = math.sin(y_angle)
+            if strafe[1]:
+                # Moving left or right.
+                dy = 0.0
+                m = 1
+            if strafe[0] > 0:
+                # Moving backwards.
+                dy *= -1
+            # When you are flying up or down, you have less left and right
+            # motion.
+            dx = math.cos(x_angle) * m
+            dz = math.sin(x_angle) * m
+        else:
+            dy = 0.0
+            dx = math.cos(x_angle)
+            dz = math.sin(x_angle)
+    else:
+        dy = 0.0
+        dx = 0.0
+        dz = 0.0
+    return (dx, dy, dz)
+
+
+def input_motion(dy, strafe, rotation, flags):
+    """ Returns the vertical velocity of a player after starting to jump, if
+    the input says so and the player is on the ground, and the velocity the
+    input moves the player at.
+
+    """
+    flying = bool(flags & INPUT_FLYING)
+    if flags & INPUT_JUMP and dy == 0:
+        dy = JUMP_SPEED
+    if flying:
+        speed = FLYING_SPEED
+    elif flags & INPUT_SLOW:
+        speed = SLOW_WALKING_SPEED
+    else:
+        speed = WALKING_SPEED
+    vx, vy, vz = motion_vector(strafe, rotation, flying)
+    return dy, (vx * speed, vy * speed, vz * speed)
+
+
+def sweep_box(world, low, high, axis, d):
+    """ Move a box along one axis through the blocks of the world, stopping
+    at the first block in the way.
+
+    Parameters
+    ----------
+    world : ChunkStore
+        The blocks of the world.
+    low, high : sequence of len 3
+        The corners of the box.
+    axis : int
+        The axis to move along.
+    d : float
+        How far to move.
+
+    Returns
+    -------
+    d : float
+        How far the box can move.
+    hit : bool
+        Whether it ran into a block.
+
+    """
+    if not d:
+        return d, False
+    e = COLLISION_EPSILON
+    a, b = [i for i in xrange(3) if i != axis]
+    # The blocks the box covers across the axis. Block n spans n - 0.5 to
+    # n + 0.5.
+    cells_a = xrange(int(math.floor(low[a] + 0.5 + e)),
+        int(math.floor(high[a] + 0.5 - e)) + 1)
+    cells_b = xrange(int(math.floor(low[b] + 0.5 + e)),
+        int(math.floor(high[b] + 0.5 - e)) + 1)
+    # The layers of blocks the leading face of the box moves into.
+    if d > 0:
+        face = high[axis]
+        layers = xrange(int(math.floor(face + 0.5 - e)) + 1,
+            int(math.floor(face + d + 0.5 - e)) + 1)
+    else:
+        face = low[axis]
+        layers = xrange(int(math.floor(face + 0.5 + e)) - 1,
+            int(math.floor(face + d + 0.5 + e)) - 1, -1)
+    cell = [0, 0, 0]
+    for layer in layers:
+        cell[axis] = layer
+        for i in cells_a:
+            cell[a] = i
+            for j in cells_b:
+                cell[b] = j
+                if tuple(cell) in world:
+                    if d > 0:
+                        return layer - 0.5 - face, True
+                    return layer + 0.5 - face, True
+    return d, False
+
+
+def sweep_boxes(world, low, high, axis, d):
+    """ Move many boxes along one axis at once, see `sweep_box()`. `low` and
+    `high` are arrays of shape (n, 3), and `d` of shape (n,). Returns arrays
+    of how far each box can move and whether it ran into a block.
+
+    """
+    hit = numpy.zeros(len(d), bool)
+    if not len(d):
+        return d, hit
+    e = COLLISION_EPSILON
+    a, b = [i for i in xrange(3) if i != axis]
+    floor = lambda v: numpy.floor(v).astype(int)
+    a0, a1 = floor(low[:, a] + 0.5 + e), floor(high[:, a] + 0.5 - e)
+    b0, b1 = floor(low[:, b] + 0.5 + e), floor(high[:, b] + 0.5 - e)
+    forward = d > 0
+    step = numpy.where(forward, 1, -1)
+    face = numpy.where(forward, high[:, axis], low[:, axis])
+    first = numpy.where(forward, floor(face + 0.5 - e) + 1,
+        floor(face + 0.5 + e) - 1)
+    last = numpy.where(forward, floor(face + d + 0.5 - e),
+        floor(face + d + 0.5 + e))
+    count = numpy.where(d != 0, (last - first) * step + 1, 0)
+    d = d.copy()
+    for k in xrange(max(count.max(), 0)):
+        active = (count > k) & ~hit
+        if not active.any():
+            break
+        layer = first + k * step
+        solid = numpy.zeros(len(d), bool)
+        for i in xrange((a1 - a0).max() + 1):
+            for j in xrange((b1 - b0).max() + 1):
+                mask = active & (a0 + i <= a1) & (b0 + j <= b1)
+                if not mask.any():
+                    continue
+                cell = [None, None, None]
+                cell[axis], cell[a], cell[b] = (layer[mask],
+                    a0[mask] + i, b0[mask] + j)
+                solid[mask] |= world.get_ids(*cell) != 0
+        stop = numpy.where(forward, layer - 0.5, layer + 0.5) - face
+        d = numpy.where(solid, stop, d)
+        hit |= solid
+    return d, hit
+
+
+def move_player(world, position, dy, strafe, rotation, flags, dt):
+    """ Advance a player by one input: walking or flying, jumping, gravity
+    and collisions. The server runs this as the authoritative simulation of
+    every player, and the client runs the same step to predict where its
+    player is before the server has answered. The whole input is one sweep
+    of the player's box along each axis in turn, see `sweep_box()`.
+
+    Parameters
+    ----------
+    world : ChunkStore
+        The blocks of the world.
+    position : tuple of len 3
+        The (x, y, z) position of the player.
+    dy : float
+        The velocity of the player in the y (upward) direction.
+    strafe, rotation :
+        The input of the player, see `Window.strafe` and `Window.rotation`.
+    flags : int
+        The INPUT_* bits of the input.
+    dt : float
+        The change in time of the input.
+
+    Returns
+    -------
+    position : tuple of len 3
+        The new position of the player.
+    dy : float
+        The new velocity of the player in the y direction.
+
+    """
+    flying = bool(flags & INPUT_FLYING)
+    dy, motion = input_motion(dy, strafe, rotation, flags)
+    dt = min(dt, 0.2)
+    delta = [m * dt for m in motion]
+    if not flying:
+        # Gravity, up to terminal velocity. Moving at the average of the old
+        # and new velocity makes jumps reach MAX_JUMP_HEIGHT exactly.
+        old_dy = dy
+        dy = max(dy - dt * GRAVITY, -TERMINAL_VELOCITY)
+        delta[1] += (old_dy + dy) / 2 * dt
+    position = list(position)
+    low = [p + l for p, l in zip(position, PLAYER_BOX[0])]
+    high = [p + h for p, h in zip(position, PLAYER_BOX[1])]
+    for axis in (1, 0, 2):
+        d, hit = sweep_box(world, low, high, axis, delta[axis])
+        position[axis] += d
+        low[axis] += d
+        high[axis] += d
+        if hit and axis == 1:
+            # Hit the ground or the ceiling, so stop falling / rising.
+            dy = 0
+    return tuple(position), dy
+
+
+def move_players(world, positions, dys, motions, flying, dt):
+    """ Advance many players at once by one input each, the same way as
+    `move_player()`.
+
+    Parameters
+    ----------
+    world : ChunkStore
+        The blocks of the world.
+    positions : array of shape (n, 3)
+        The positions of the players.
+    dys : array of shape (n,)
+        The velocities of the players in the y direction, after
+        `input_motion()`.
+    motions : array of shape (n, 3)
+        The velocities the inputs move the players at, see `input_motion()`.
+    flying : array of shape (n,)
+        Whether each player is flying.
+    dt : float
+        The change in time of the inputs.
+
+    Returns
+    -------
+    positions, dys
+        The new positions and vertical velocities of the players.
+
+    """
+    positions = numpy.array(positions, float).reshape(-1, 3)
+    dys = numpy.array(dys, float)
+    flying = numpy.array(flying, bool)
+    dt = min(dt, 0.2)
+    delta = numpy.array(motions, float).reshape(-1, 3) * dt
+    new_dys = numpy.where(flying, dys,
+        numpy.maximum(dys - dt * GRAVITY, -TERMINAL_VELOCITY))
+    delta[:, 1] += numpy.where(flying, 0.0, (dys + new_dys) / 2 * dt)
+    low = positions + PLAYER_BOX[0]
+    high = positions + PLAYER_BOX[1]
+    for axis in (1, 0, 2):
+        d, hit = sweep_boxes(world, low, high, axis, delta[:, axis])
+        positions[:, axis] += d
+        low[:, axis] += d
+        high[:, axis] += d
+        if axis == 1:
+            new_dys[hit] = 0
+    return positions, new_dys
+
+# Represents any player which is not the current player, drawn as a brick
+#   entity. The server keeps one for every player to simulate it; those
+#   aren't shown, as the clients show the players from the positions the
+#   server sends them.
 class NetworkPlayer(object):
-    def __init__(self, position):
-        self.__firstrun = True
+    def __init__(self, position, visible=True):
+        self.visible = visible
+        if visible:
+            WINDOW.entities.add(self, BLOCKS["BRICK"], PLAYER_BOX)
         self.setPosition(position)
-        self.__firstrun = False
-        self.strafe = [0,0]
-        self.flying = False
         self.dy = 0
         self.rotation = (0, 0)
     def setPosition(self, position):
-        if(self.__firstrun == False):
-            WINDOW.model.remove_block(self._position, immediate=True)
         self._position = position
-        WINDOW.model.add_block(position, BLOCKS["BRICK"], immediate=True)
+        if self.visible:
+            WINDOW.entities.move(self, position)
 
     def getPosition(self):
         return self._position
 
-    def update(self, dt):
-        m = 8
-        dt = min(dt, 0.2)
-        for _ in xrange(m):
-            self._update(dt / m)
+    def remove(self):
+        if self.visible:
+            WINDOW.entities.remove(self)
+            self.visible = False
+
+    # Run one input each for many players at once, as part of the server's
+    #   simulation. `inputs` holds a (strafe, rotation, flags) tuple for each
+    #   of `players`.
+    @staticmethod
+    def apply_inputs(players, inputs, dt):
+        dys, motions, flying = [], [], []
+        for player, (strafe, rotation, flags) in zip(players, inputs):
+            player.rotation = rotation
+            dy, motion = input_motion(player.dy, strafe, rotation, flags)
+            dys.append(dy)
+            motions.append(motion)
+            flying.append(bool(flags & INPUT_FLYING))
+        positions, dys = move_players(WINDOW.model.world,
+            [player.getPosition() for player in players], dys, motions,
+            flying, dt)
+        for player, position, dy in zip(players, positions.tolist(), dys):
+            player.setPosition(tuple(position))
+            player.dy = float(dy)
+
+class EntityGroup(pyglet.graphics.Group):
+    """ Draws the vertex lists in it moved to the position of an entity, so
+    moving the entity doesn't touch its vertices.
 
-    def _update(self, dt):
-        # walking
-        speed = FLYING_SPEED if self.flying else ACTUAL_WALKING_SPEED
-        d = dt * speed # distance covered this tick.
-        dx, dy, dz = self.get_motion_vector()
-        # New position in space, before accounting for gravity.
-        dx, dy, dz = dx * d, dy * d, dz * d
-        # gravity
-        if not self.flying:
-            # Update your vertical speed: if you are falling, speed up until you
-            # hit terminal velocity; if you are jumping, slow down until you
-            # start falling.
-            self.dy -= dt * GRAVITY
-            self.dy = max(self.dy, -TERMINAL_VELOCITY)
-            dy += self.dy * dt
-        # collisions
-        x, y, z = self._position
-        x, y, z = self.collide((x + dx, y + dy, z + dz), PLAYER_HEIGHT)
-        self.setPosition((x, y, z))
-
-    def get_motion_vector(self):
-        """ Returns the current motion vector indicating the velocity of the
-        NetworkPlayer.
+    """
 
-        Returns
-        -------
-        vector : tuple of len 3
-            Tuple containing the velocity in x, y, and z respectively.
+    def __init__(self, parent=None):
+        super(EntityGroup, self).__init__(parent)
+        self.position = (0, 0, 0)
 
-        """
-        if any(self.strafe):
-            x, y = self.rotation
-            strafe = math.degrees(math.atan2(*self.strafe))
-            y_angle = math.radians(y)
-            x_angle = math.radians(x + strafe)
-            if self.flying:
-                m = math.cos(y_angle)
-                dy = math.sin(y_angle)
-                if self.strafe[1]:
-                    # Moving left or right.
-                    dy = 0.0
-                    m = 1
-                if self.strafe[0] > 0:
-                    # Moving backwards.
-                    dy *= -1
-                # When you are flying up or down, you have less left and right
-                # motion.
-                dx = math.cos(x_angle) * m
-                dz = math.sin(x_angle) * m
-            else:
-                dy = 0.0
-                dx = math.cos(x_angle)
-                dz = math.sin(x_angle)
-        else:
-            dy = 0.0
-            dx = 0.0
-            dz = 0.0
-        return (dx, dy, dz)
+    def set_state(self):
+        glPushMatrix()
+        glTranslatef(*self.position)
+
+    def unset_state(self):
+        glPopMatrix()
+
+
+class Entities(object):
+    """ Things that move around the world on their own, such as other
+    players. They are drawn from a batch of their own, each with its own
+    transform, and are not part of `Model.world`, so they neither collide
+    with anything nor cause sectors to be meshed again.
+
+    """
+
+    def __init__(self):
+        self.batch = pyglet.graphics.Batch()
+
+        # Mapping from key to the EntityGroup and vertex list of each entity.
+        self.entities = {}
 
-    def collide(self, position, height):
-        """ Checks to see if the player at the given `position` and `height`
-        is colliding with any blocks in the world.
+    def add(self, key, block, box):
+        """ Add an entity drawn as a box with the texture of `block`.
 
         Parameters
         ----------
-        position : tuple of len 3
-            The (x, y, z) position to check for collisions at.
-        height : int or float
-            The height of the player.
+        key : hashable
+            Identifies the entity in calls to `move()` and `remove()`.
+        block : Block
+            The block whose texture the box has.
+        box : tuple of len 2
+            The low and high (x, y, z) corners of the box, relative to the
+            position of the entity.
+
+        """
+        group = EntityGroup(block.group)
+        vertex_list = self.batch.add(24, GL_QUADS, group,
+            ('v3f/static', box_vertices(*box)),
+            ('t2f/static', block.texture_coords))
+        self.entities[key] = (group, vertex_list)
+
+    def move(self, key, position):
+        """ Move the entity `key` to `position`.
+
+        """
+        self.entities[key][0].position = position
+
+    def remove(self, key):
+        """ Remove the entity `key`.
+
+        """
+        group, vertex_list = self.entities.pop(key)
+        vertex_list.delete()
+
+    def draw(self):
+        self.batch.draw()
 
-        Returns
-        -------
-        position : tuple of len 3
-            The new position of the player taking into account collisions.
-
-        """
-        # How much overlap with a dimension of a surrounding block you need to
-        # have to count as a collision. If 0, touching terrain at all counts as
-        # a collision. If .49, you sink into the ground, as if walking through
-        # tall grass. If >= .5, you'll fall through the ground.
-        pad = 0.25
-        p = list(position)
-        np = normalize(position)
-        for face in FACES:  # check all surrounding blocks
-            for i in xrange(3):  # check each dimension independently
-                if not face[i]:
-                    continue
-                # How much overlap you have with this dimension.
-                d = (p[i] - np[i]) * face[i]
-                if d < pad:
-                    continue
-                for dy in xrange(height):  # check each height
-                    op = list(np)
-                    op[1] -= dy
-                    op[i] += face[i]
-                    if tuple(op) not in WINDOW.model.world:
-                        continue
-                    p[i] -= (d - pad) * face[i]
-                    if face == (0, -1, 0) or face == (0, 1, 0):
-                        # You are colliding with the ground or ceiling, so stop
-                        # falling / rising.
-                        self.dy = 0
-                    break
-        return tuple(p)
 
 class Window(pyglet.window.Window):
 
     def __init__(self, *args, **kwargs):
+        # Whether the world comes from a server rather than from disk.
+        remote = kwargs.pop('remote', False)
         super(Window, self).__init__(*args, **kwargs)
 
         # Whether or not the window exclusively captures the mouse.
@@ -1205,6 +3544,10 @@ class Window(pyglet.window.Window):
         # that, perhaps unlike in math class, the y-axis is the vertical axis.
         self.position = (0, 0, 0)
 
+        # The position before the last step of the simulation. The camera is
+        # drawn between it and `position`, see `get_camera_position()`.
+        self.previous_position = self.position
+
         # First element is rotation of the player in the x-z plane (ground
         # plane) measured from the z-axis down. The second is the rotation
         # angle from the ground plane up. Rotation is in degrees.
@@ -1222,24 +3565,75 @@ class Window(pyglet.window.Window):
         # Velocity in the y (upward) direction.
         self.dy = 0
 
+        # Whether the player jumps on the next input.
+        self.jumping = False
+
+        # Whether the player walks slowly.
+        self.slow = False
+
+        # Time not yet covered by a step of the simulation.
+        self.accumulator = 0.0
+
+        # The time the world may spend building sectors each frame, adapted
+        # to how long frames take, see `update()`.
+        self.queue_budget = 1.0 / TICKS_PER_SEC
+
+        # Whether the player was moved somewhere new by the server, so the
+        # sectors around it are built right away.
+        self.teleported = False
+
+        # Seconds from the start of the game until the first frame was drawn,
+        # and until every sector in view was built, once they have been.
+        self.first_frame = None
+        self.view_complete = None
+
+        # The inputs sent to the server that it hasn't acknowledged yet, as
+        # (sequence, strafe, rotation, flags) tuples.
+        self.input_sequence = 0
+        self.pending_inputs = deque()
+
         # Convenience list of num keys.
         self.num_keys = [
             key._1, key._2, key._3, key._4, key._5,
             key._6, key._7, key._8, key._9, key._0]
 
+        # The other players.
+        self.entities = Entities()
+
         # Instance of the model that handles the world.
-        self.model = Model()
+        self.model = Model(path=None if remote else WORLD_PATH, remote=remote)
+
+        # The result of the last line of sight search, and the position,
+        # rotation and world revision it was made for.
+        self._target = None
+        self._target_key = None
+
+        # The vertex list outlining the focused block, and that block.
+        self._outline = None
+        self._outline_block = None
 
         # The label that is displayed in the top left of the canvas.
         self.label = pyglet.text.Label('', font_name='Arial', font_size=18,
             x=10, y=self.height - 10, anchor_x='left', anchor_y='top',
             color=(0, 0, 0, 255))
 
+        # The breakdown of the profiler below it, while profiling, and when
+        # its text was last updated.
+        self.profile_label = pyglet.text.Label('', font_name='Courier New',
+            font_size=10, x=10, y=self.height - 40, width=400,
+            multiline=True, anchor_x='left', anchor_y='top',
+            color=(0, 0, 0, 255))
+        self._profile_shown = 0.0
+
         self.drawregister = DrawRegister()
 
-        # This call schedules the `update()` method to be called
-        # TICKS_PER_SEC. This is the main game event loop.
-        pyglet.clock.schedule_interval(self.update, 1.0 / TICKS_PER_SEC)
+        # This call schedules the `update()` method to be called every frame,
+        # FRAME_RATE times a second or as often as possible. This is the main
+        # game event loop.
+        if FRAME_RATE is None:
+            pyglet.clock.schedule(self.update)
+        else:
+            pyglet.clock.schedule_interval(self.update, 1.0 / FRAME_RATE)
 
         self.UI = UI(self)
         self.player = Player(self)
@@ -1270,48 +3664,12 @@ class Window(pyglet.window.Window):
         dz = math.sin(math.radians(x - 90)) * m
         return (dx, dy, dz)
 
-    def get_motion_vector(self):
-        """ Returns the current motion vector indicating the velocity of the
-        player.
-
-        Returns
-        -------
-        vector : tuple of len 3
-            Tuple containing the velocity in x, y, and z respectively.
-
-        """
-        if any(self.strafe):
-            x, y = self.rotation
-            strafe = math.degrees(math.atan2(*self.strafe))
-            y_angle = math.radians(y)
-            x_angle = math.radians(x + strafe)
-            if self.flying:
-                m = math.cos(y_angle)
-                dy = math.sin(y_angle)
-                if self.strafe[1]:
-                    # Moving left or right.
-                    dy = 0.0
-                    m = 1
-                if self.strafe[0] > 0:
-                    # Moving backwards.
-                    dy *= -1
-                # When you are flying up or down, you have less left and right
-                # motion.
-                dx = math.cos(x_angle) * m
-                dz = math.sin(x_angle) * m
-            else:
-                dy = 0.0
-                dx = math.cos(x_angle)
-                dz = math.sin(x_angle)
-        else:
-            dy = 0.0
-            dx = 0.0
-            dz = 0.0
-        return (dx, dy, dz)
-
+    @PROFILER.profile('update')
     def update(self, dt):
-        """ This method is scheduled to be called repeatedly by the pyglet
-        clock.
+        """ This method is scheduled to be called by the pyglet clock before
+        every frame. Runs as many fixed steps of the simulation as the time
+        since the last frame covers, keeping the rest for the next frame, so
+        the simulation doesn't depend on the frame rate.
 
         Parameters
         ----------
@@ -1319,97 +3677,134 @@ class Window(pyglet.window.Window):
             The change in time since the last call.
 
         """
-        global CLIENTSERVER
-        if 'CLIENTSERVER' in globals():
-            CLIENTSERVER.update(dt)
-
-        self.model.process_queue()
-        self.world_items.process_queue()
-        sector = sectorize(self.position)
-        if sector != self.sector:
-            self.model.change_sectors(self.sector, sector)
-            if self.sector is None:
-                self.model.process_entire_queue()
-            self.sector = sector
-        m = 8
-        dt = min(dt, 0.2)
-        for _ in xrange(m):
-            self._update(dt / m)
+        step = 1.0 / TICKS_PER_SEC
+        # Spend less time building sectors while frames run late, and more
+        # while they don't.
+        if dt > 1.25 / (FRAME_RATE or TICKS_PER_SEC):
+            self.queue_budget = max(self.queue_budget / 2, MIN_QUEUE_BUDGET)
+        else:
+            self.queue_budget = min(self.queue_budget + MIN_QUEUE_BUDGET, step)
+        self.accumulator = min(self.accumulator + dt, 0.2)
+        if self.accumulator < step and self.sector is not None:
+            # Nothing to simulate yet; the frame is drawn between the last
+            # two steps.
+            return
+        self.model.look(self.get_sight_vector())
+        with PROFILER.scope('update.model_queue'):
+            self.model.process_queue(self.queue_budget)
+        if (self.view_complete is None and self.sector is not None and
+                not self.model.loading()):
+            self.view_complete = time.time() - STARTED
+            print "View complete after %.2f seconds" % self.view_complete
+        with PROFILER.scope('update.world_items_queue'):
+            self.world_items.process_queue(self.queue_budget)
+        while True:
+            sector = sectorize(self.position)
+            if sector != self.sector:
+                # Make sure there is ground to stand on, even if the
+                # background jobs haven't got to these sectors yet.
+                with PROFILER.scope('update.change_sectors'):
+                    for nearby in sectors_around(sector, 1, 1):
+                        self.model.ensure_generated(nearby)
+                    self.model.change_sectors(self.sector, sector)
+                    if self.sector is None or self.teleported:
+                        # Build the sectors around the player right away,
+                        # and let the rest stream in from the queue.
+                        self.model.load_around(sector)
+                self.sector = sector
+                if self.model.remote:
+                    CLIENT.send_view(sector)
+            self.teleported = False
+            if (self.model.remote and not
+                    sectors_around(sector, 1, 1) <= self.model.generated):
+                # Nothing to stand on until the server sends the sectors
+                # around the player.
+                self.accumulator = 0.0
+                self.previous_position = self.position
+                return
+            if self.accumulator < step:
+                return
+            # The player moves in inputs of a fixed length, so the server
+            # can replay them exactly.
+            self.accumulator -= step
+            self.previous_position = self.position
+            self._update(step)
 
+    @PROFILER.profile('update.step')
     def _update(self, dt):
-        """ Private implementation of the `update()` method. This is where most
-        of the motion logic lives, along with gravity and collision detection.
+        """ Private implementation of the `update()` method. Runs one input
+        of the player: predicts its effect with `move_player()` and sends it
+        to the server, which runs the same step and reports back the result
+        to `reconcile()`.
 
         Parameters
         ----------
         dt : float
-            The change in time since the last call.
+            The change in time of the input.
 
         """
-        # walking
-        speed = FLYING_SPEED if self.flying else ACTUAL_WALKING_SPEED
-        d = dt * speed # distance covered this tick.
-        dx, dy, dz = self.get_motion_vector()
-        # New position in space, before accounting for gravity.
-        dx, dy, dz = dx * d, dy * d, dz * d
-        # gravity
-        if not self.flying:
-            # Update your vertical speed: if you are falling, speed up until you
-            # hit terminal velocity; if you are jumping, slow down until you
-            # start falling.
-            self.dy -= dt * GRAVITY
-            self.dy = max(self.dy, -TERMINAL_VELOCITY)
-            dy += self.dy * dt
-        # collisions
-        x, y, z = self.position
-        x, y, z = self.collide((x + dx, y + dy, z + dz), PLAYER_HEIGHT)
-        self.position = (x, y, z)
+        flags = 0
+        if self.flying:
+            flags |= INPUT_FLYING
+        if self.jumping:
+            flags |= INPUT_JUMP
+            self.jumping = False
+        if self.slow:
+            flags |= INPUT_SLOW
+        strafe = tuple(self.strafe)
+        self.position, self.dy = move_player(self.model.world, self.position,
+            self.dy, strafe, self.rotation, flags, dt)
+        if 'CLIENT' in globals() and CLIENT.uuid is not None:
+            self.input_sequence += 1
+            self.pending_inputs.append(
+                (self.input_sequence, strafe, self.rotation, flags))
+            CLIENT.send_input(self.input_sequence, strafe, self.rotation,
+                flags)
+
+    def teleport(self, position):
+        """ Move the player to `position` without moving through the world
+        in between.
+
+        """
+        self.position = self.previous_position = position
+        self.teleported = True
+
+    def edit_block(self, position, block):
+        """ Place `block` at `position`, or remove the block there if `block`
+        is None, and tell the server.
+
+        """
+        if block is None:
+            self.model.remove_block(position)
+        else:
+            self.model.add_block(position, block)
+        if 'CLIENT' in globals():
+            CLIENT.send_block(position, block)
 
-    def collide(self, position, height):
-        """ Checks to see if the player at the given `position` and `height`
-        is colliding with any blocks in the world.
+    def reconcile(self, sequence, position, dy):
+        """ Correct the predicted state of the player with the state the
+        server computed after input `sequence`, replaying the inputs the
+        server hasn't processed yet on top of it. Since both sides run the
+        same step, the correction is normally too small to see.
 
         Parameters
         ----------
+        sequence : int
+            The last input the server processed.
         position : tuple of len 3
-            The (x, y, z) position to check for collisions at.
-        height : int or float
-            The height of the player.
+            The position of the player after that input.
+        dy : float
+            The velocity of the player in the y direction after that input.
 
-        Returns
-        -------
-        position : tuple of len 3
-            The new position of the player taking into account collisions.
-
-        """
-        # How much overlap with a dimension of a surrounding block you need to
-        # have to count as a collision. If 0, touching terrain at all counts as
-        # a collision. If .49, you sink into the ground, as if walking through
-        # tall grass. If >= .5, you'll fall through the ground.
-        pad = 0.25
-        p = list(position)
-        np = normalize(position)
-        for face in FACES:  # check all surrounding blocks
-            for i in xrange(3):  # check each dimension independently
-                if not face[i]:
-                    continue
-                # How much overlap you have with this dimension.
-                d = (p[i] - np[i]) * face[i]
-                if d < pad:
-                    continue
-                for dy in xrange(height):  # check each height
-                    op = list(np)
-                    op[1] -= dy
-                    op[i] += face[i]
-                    if tuple(op) not in self.model.world:
-                        continue
-                    p[i] -= (d - pad) * face[i]
-                    if face == (0, -1, 0) or face == (0, 1, 0):
-                        # You are colliding with the ground or ceiling, so stop
-                        # falling / rising.
-                        self.dy = 0
-                    break
-        return tuple(p)
+        """
+        pending = self.pending_inputs
+        while pending and pending[0][0] <= sequence:
+            pending.popleft()
+        dt = 1.0 / TICKS_PER_SEC
+        for _, strafe, rotation, flags in pending:
+            position, dy = move_player(self.model.world, position, dy,
+                strafe, rotation, flags, dt)
+        self.position, self.dy = position, dy
 
     def on_mouse_press(self, x, y, button, modifiers):
         """ Called when a mouse button is pressed. See pyglet docs for button
@@ -1429,8 +3824,7 @@ class Window(pyglet.window.Window):
 
         """
         if self.exclusive:
-            vector = self.get_sight_vector()
-            block, previous = self.model.hit_test(self.position, vector)
+            block, previous, _ = self.get_target()
             if (button == mouse.RIGHT) or \
                     ((button == mouse.LEFT) and (modifiers & key.MOD_CTRL)):
                 # ON OSX, control + left click = right click.
@@ -1445,7 +3839,6 @@ class Window(pyglet.window.Window):
                         self.player.selected.use(previous)
                 else:
                     if texture != BLOCKS["STONE"]:
-                        CLIENT.send(dict(msg="action", action="player.attack", player_position=str(WINDOW.position), player_orientation=str(WINDOW.get_sight_vector()), target_position=str(block)))
                         self.player.selected.use(block)
         else:
             self.set_exclusive_mouse(True)
@@ -1483,41 +3876,35 @@ class Window(pyglet.window.Window):
         """
         if symbol == key.W:
             self.strafe[0] -= 1
-            CLIENT.send(dict(msg="action", action="player.move.forward.start", player_position=str(WINDOW.position), player_orientation=str(WINDOW.get_sight_vector())))
         elif symbol == key.S:
             self.strafe[0] += 1
-            CLIENT.send(dict(msg="action", action="player.move.backwards.start", player_position=str(WINDOW.position), player_orientation=str(WINDOW.get_sight_vector())))
         elif symbol == key.A:
             self.strafe[1] -= 1
-            CLIENT.send(dict(msg="action", action="player.move.left.start", player_position=str(WINDOW.position), player_orientation=str(WINDOW.get_sight_vector())))
         elif symbol == key.D:
             self.strafe[1] += 1
-            CLIENT.send(dict(msg="action", action="player.move.right.start", player_position=str(WINDOW.position), player_orientation=str(WINDOW.get_sight_vector())))
         elif symbol == key.Q:
             self.player.selected.drop()
-            CLIENT.send(dict(msg="action", action="player.selected.drop", player_position=str(WINDOW.position), player_orientation=str(WINDOW.get_sight_vector())))
         elif symbol == key.E:
-            CLIENT.send(dict(msg="action", action="player.pickup", player_position=str(WINDOW.position), player_orientation=str(WINDOW.get_sight_vector())))
             self.player.pickup()
         elif symbol == key.SPACE:
-            if self.dy == 0:
-                self.dy = JUMP_SPEED
-                CLIENT.send(dict(msg="action", action="player.jump", player_position=str(WINDOW.position), player_orientation=str(WINDOW.get_sight_vector())))
+            self.jumping = True
         elif symbol == key.ESCAPE:
             #self.set_exclusive_mouse(False)
             #CLIENT.send("client.disconnect")
             reactor.stop()
         elif symbol == key.TAB:
             self.flying = not self.flying
+        elif symbol == key.F3:
+            PROFILER.toggle()
+        elif symbol == key.F4:
+            path = time.strftime('trace-%Y%m%d-%H%M%S.json')
+            PROFILER.export_trace(path)
+            print "Wrote trace to " + path
         elif symbol in self.num_keys:
             index = (symbol - self.num_keys[0]) % len(self.player.inventory.inventory)
             self.player.selected = self.player.inventory.inventory[index]
             self.UI.informItemKeyPressed(index)
-        global ACTUAL_WALKING_SPEED
-        if modifiers & key.LSHIFT:
-            ACTUAL_WALKING_SPEED = 2
-        else:
-            ACTUAL_WALKING_SPEED = 5
+        self.slow = bool(modifiers & key.LSHIFT)
 
     def on_key_release(self, symbol, modifiers):
         """ Called when the player releases a key. See pyglet docs for key
@@ -1533,21 +3920,13 @@ class Window(pyglet.window.Window):
         """
         if symbol == key.W:
             self.strafe[0] += 1
-            CLIENT.send(dict(msg="action", action="player.move.forward.stop", player_position=str(WINDOW.position), player_orientation=str(WINDOW.get_sight_vector())))
         elif symbol == key.S:
             self.strafe[0] -= 1
-            CLIENT.send(dict(msg="action", action="player.move.backwards.stop", player_position=str(WINDOW.position), player_orientation=str(WINDOW.get_sight_vector())))
         elif symbol == key.A:
             self.strafe[1] += 1
-            CLIENT.send(dict(msg="action", action="player.move.left.stop", player_position=str(WINDOW.position), player_orientation=str(WINDOW.get_sight_vector())))
         elif symbol == key.D:
             self.strafe[1] -= 1
-            CLIENT.send(dict(msg="action", action="player.move.right.stop", player_position=str(WINDOW.position), player_orientation=str(WINDOW.get_sight_vector())))
-        global ACTUAL_WALKING_SPEED
-        if modifiers & key.LSHIFT:
-            ACTUAL_WALKING_SPEED = 2
-        else:
-            ACTUAL_WALKING_SPEED = 5
+        self.slow = bool(modifiers & key.LSHIFT)
 
     def on_resize(self, width, height):
         """ Called when the window is resized to a new `width` and `height`.
@@ -1555,6 +3934,7 @@ class Window(pyglet.window.Window):
         """
         # label
         self.label.y = height - 10
+        self.profile_label.y = height - 40
         # reticle
         if self.reticle:
             self.reticle.delete()
@@ -1577,6 +3957,17 @@ class Window(pyglet.window.Window):
         glMatrixMode(GL_MODELVIEW)
         glLoadIdentity()
 
+    def get_camera_position(self):
+        """ Returns the position to draw the world from: between the
+        positions of the last two steps of the simulation, by how far the
+        time since then is into the next step, so the camera moves smoothly
+        whatever the frame rate.
+
+        """
+        t = self.accumulator * TICKS_PER_SEC
+        return tuple(a + (b - a) * t
+            for a, b in zip(self.previous_position, self.position))
+
     def set_3d(self):
         """ Configure OpenGL to draw in 3d.
 
@@ -1586,15 +3977,39 @@ class Window(pyglet.window.Window):
         glViewport(0, 0, width, height)
         glMatrixMode(GL_PROJECTION)
         glLoadIdentity()
-        gluPerspective(65.0, width / float(height), 0.1, 60.0)
+        gluPerspective(FIELD_OF_VIEW, width / float(height), NEAR_PLANE,
+            FAR_PLANE)
         glMatrixMode(GL_MODELVIEW)
         glLoadIdentity()
         x, y = self.rotation
         glRotatef(x, 0, 1, 0)
         glRotatef(-y, math.cos(math.radians(x)), 0, math.sin(math.radians(x)))
-        x, y, z = self.position
+        x, y, z = self.get_camera_position()
         glTranslatef(-x, -y, -z)
 
+    def get_target(self):
+        """ Returns the block under the crosshairs, the block in front of it
+        and the face hit, as returned by `Model.hit_test()`. The result is
+        reused until the player moves or turns or the world changes, so the
+        drawing and the input handlers of a frame share one search.
+
+        """
+        key = (self.position, self.rotation, self.model.revision)
+        if key != self._target_key:
+            self._target_key = key
+            self._target = self.model.hit_test(self.position,
+                self.get_sight_vector())
+        return self._target
+
+    def get_frustum(self):
+        """ Returns the `Frustum` of what the player can currently see.
+
+        """
+        width, height = self.get_size()
+        return Frustum(self.get_camera_position(), self.rotation,
+            width / float(height))
+
+    @PROFILER.profile('draw')
     def on_draw(self):
         """ Called by pyglet to draw the canvas.
 
@@ -1602,20 +4017,32 @@ class Window(pyglet.window.Window):
         self.clear()
         self.set_3d()
         glColor3d(1, 1, 1)
-        self.model.batch.draw()
-        self.world_items.batch.draw()
-        self.draw_focused_block()
-        self.set_2d()
-        self.draw_label()
-        self.draw_reticle()
+        with PROFILER.scope('draw.terrain'):
+            self.model.draw(self.get_frustum(),
+                sectorize(self.get_camera_position()))
+        with PROFILER.scope('draw.world_items'):
+            self.world_items.batch.draw()
+        with PROFILER.scope('draw.entities'):
+            self.entities.draw()
+        with PROFILER.scope('draw.focused_block'):
+            self.draw_focused_block()
+        with PROFILER.scope('draw.hud'):
+            self.set_2d()
+            self.draw_label()
+            self.draw_reticle()
 
         # Enable alpha on objects (experimental)
         glBlendFunc(GL_SRC_ALPHA, GL_ONE_MINUS_SRC_ALPHA);
         glEnable( GL_BLEND );
 
         # Draw everything that's been added to the drawregister.
-        for reg in self.drawregister.drawregister:
-            reg()
+        with PROFILER.scope('draw.drawregister'):
+            for reg in self.drawregister.drawregister:
+                reg()
+
+        if self.first_frame is None:
+            self.first_frame = time.time() - STARTED
+            print "First frame after %.2f seconds" % self.first_frame
 
 
 
@@ -1624,14 +4051,21 @@ class Window(pyglet.window.Window):
         crosshairs.
 
         """
-        vector = self.get_sight_vector()
-        block = self.model.hit_test(self.position, vector)[0]
-        if block:
-            x, y, z = block
-            vertex_data = cube_vertices(x, y, z, 0.51)
+        block = self.get_target()[0]
+        if block != self._outline_block:
+            self._outline_block = block
+            if self._outline is not None:
+                self._outline.delete()
+                self._outline = None
+            if block:
+                x, y, z = block
+                vertex_data = cube_vertices(x, y, z, 0.51)
+                self._outline = pyglet.graphics.vertex_list(24,
+                    ('v3f/static', vertex_data))
+        if self._outline is not None:
             glColor3d(0, 0, 0)
             glPolygonMode(GL_FRONT_AND_BACK, GL_LINE)
-            pyglet.graphics.draw(24, GL_QUADS, ('v3f/static', vertex_data))
+            self._outline.draw(GL_QUADS)
             glPolygonMode(GL_FRONT_AND_BACK, GL_FILL)
 
     def draw_label(self):
@@ -1639,10 +4073,20 @@ class Window(pyglet.window.Window):
 
         """
         x, y, z = self.position
-        self.label.text = '%02d (%.2f, %.2f, %.2f) %d / %d' % (
+        self.label.text = '%02d (%.2f, %.2f, %.2f) %d / %d %d drawn %d culled %d occluded' % (
             pyglet.clock.get_fps(), x, y, z,
-            len(self.model._shown), len(self.model.world))
+            self.model.quad_count, len(self.model.world),
+            self.model.drawn_sectors, self.model.culled_sectors,
+            self.model.occluded_sectors)
         self.label.draw()
+        if PROFILER.enabled:
+            # Laying out the text is slow, so it is only done a few times a
+            # second.
+            now = time.time()
+            if now - self._profile_shown > 0.25:
+                self._profile_shown = now
+                self.profile_label.text = PROFILER.breakdown()
+            self.profile_label.draw()
 
     def draw_reticle(self):
         """ Draw the crosshairs in the center of the screen.
@@ -1667,8 +4111,8 @@ def setup_fog():
     glFogi(GL_FOG_MODE, GL_LINEAR)
     # How close and far away fog starts and ends. The closer the start and end,
     # the denser the fog in the fog range.
-    glFogf(GL_FOG_START, 20.0)
-    glFogf(GL_FOG_END, 60.0)
+    glFogf(GL_FOG_START, 40.0)
+    glFogf(GL_FOG_END, 96.0)
 
 
 def setup():
@@ -1695,31 +4139,52 @@ def main():
     global CLIENT
     global STARTING_POSITION
     global CLIENTSERVER
+    global FRAME_RATE
 
     STARTING_POSITION = (0, 0, 0)
     LISTENSERVER = True
 
-    if len(sys.argv) == 2:
+    print "Imports done after %.2f seconds" % (time.time() - STARTED)
+
+    args = sys.argv[1:]
+    if '--uncapped' in args:
+        # Draw frames as fast as possible, to measure the real frame rate.
+        args.remove('--uncapped')
+        FRAME_RATE = None
+    if '--profile' in args:
+        # Profile from the start, and write a trace of the end of the session
+        # when it's over.
+        args.remove('--profile')
+        PROFILER.enabled = True
+    if len(args) == 1:
         LISTENSERVER = False
-    elif len(sys.argv) > 2:
+    elif len(args) > 1:
         print "Too many arguments. To connect to a server, the IP address or hostname of the server must be provided as the only argument."
         return
 
     CLIENTSERVER = MultiplayerClientServer()
     if LISTENSERVER == True:
         SERVER = MultiplayerServerServer()
-        CLIENT = MultiplayerClientClient("localhost")
+        CLIENT = MultiplayerClientClient("localhost", local=True)
     else:
         SERVER = False
-        CLIENT = MultiplayerClientClient(sys.argv[1])
+        CLIENT = MultiplayerClientClient(args[0])
 
-    __builtin__.WINDOW = Window(width=800, height=600, caption='Pyglet', resizable=True)
+    # Players joining someone else's server get the world from it, so they
+    # need no workers generating it.
+    if LISTENSERVER:
+        start_workers()
+    __builtin__.WINDOW = Window(width=800, height=600, caption='Pyglet', resizable=True, vsync=FRAME_RATE is not None, remote=not LISTENSERVER)
     # Hide the mouse cursor and prevent the mouse from leaving the WINDOW.
     WINDOW.set_exclusive_mouse(True)
     setup()
 
     #CLIENT.send("HELLO!")
     reactor.run()
+    WINDOW.model.close()
+    stop_workers()
+    if PROFILER.enabled:
+        PROFILER.export_trace('trace.json')
 
 from netifaces import interfaces, ifaddresses, AF_INET
 def ipv4_addresses():
@@ -1732,11 +4197,133 @@ def ipv4_addresses():
             pass # Skip KeyError since it's possible to be caused by various device configurations.
     return ip_list
 
-class MultiplayerClientClient:
-    def __init__(self, addr):
-        self.connected = False
+# Wire protocol. Every message is the protocol version and an opcode, followed
+# by the fields of that opcode packed as in MESSAGES. UUIDs travel as their 16
+# raw bytes, positions and vectors as float32s and blocks as int32s.
+PROTOCOL_VERSION = 5
+
+MSG_INIT = 1
+MSG_UUID = 2
+MSG_PLAYER_POSITION = 3
+MSG_NETWORKPLAYER_POSITION = 6
+MSG_INPUT = 7
+MSG_STATE = 8
+MSG_VIEW = 9
+MSG_SECTOR = 10
+MSG_BLOCK = 11
+MSG_BLOCK_DELTA = 12
+MSG_NETWORKPLAYER_REMOVE = 13
+
+MESSAGES = {
+    # IPv4 address of the client's own server.
+    MSG_INIT: '4s',
+    # UUID given to the client.
+    MSG_UUID: '16s',
+    # Position the client starts at.
+    MSG_PLAYER_POSITION: '3f',
+    # UUID and position of a player.
+    MSG_NETWORKPLAYER_POSITION: '16s3f',
+    # UUID, sequence number, strafe, rotation and INPUT_* flags of one input
+    # of a player, lasting 1 / TICKS_PER_SEC seconds.
+    MSG_INPUT: '16sIbb2fB',
+    # Sequence number of the last input the server processed, and the
+    # position and vertical velocity of the player after it.
+    MSG_STATE: 'I3ff',
+    # UUID of a player and the sector it moved into.
+    MSG_VIEW: '16s3i',
+    # Sector, sequence number of the last block change in it, and the length
+    # of its chunks, compressed, which follow the message.
+    MSG_SECTOR: '3iII',
+    # UUID of a player, and the position and ID of the block it placed there,
+    # 0 if it removed the block.
+    MSG_BLOCK: '16s3iH',
+    # Sequence number of a block change, and the position and ID of the
+    # block, 0 if it was removed.
+    MSG_BLOCK_DELTA: 'I3iH',
+    # UUID of a player that went out of range or left the game.
+    MSG_NETWORKPLAYER_REMOVE: '16s',
+}
+
+# Messages whose last field is the length of a string following them. The
+# string is given to encode_message() and yielded by decode_messages() in
+# place of the length.
+BLOB_MESSAGES = set([MSG_SECTOR])
+
+HEADER = struct.Struct('<BB')
+PACKERS = dict((opcode, struct.Struct('<BB' + fields))
+    for opcode, fields in MESSAGES.iteritems())
+
+def encode_message(opcode, *fields):
+    if opcode in BLOB_MESSAGES:
+        blob = fields[-1]
+        fields = fields[:-1] + (len(blob),)
+        return PACKERS[opcode].pack(PROTOCOL_VERSION, opcode, *fields) + blob
+    return PACKERS[opcode].pack(PROTOCOL_VERSION, opcode, *fields)
+
+# Yields the opcode and fields of each message in a packet of one or more
+# messages. Raises ValueError for messages from other protocol versions.
+def decode_messages(pkt):
+    offset = 0
+    while offset < len(pkt):
+        version, opcode = HEADER.unpack_from(pkt, offset)
+        if version != PROTOCOL_VERSION:
+            raise ValueError("Unsupported protocol version %d" % version)
+        packer = PACKERS[opcode]
+        fields = packer.unpack_from(pkt, offset)[2:]
+        offset += packer.size
+        if opcode in BLOB_MESSAGES:
+            size = fields[-1]
+            fields = fields[:-1] + (pkt[offset:offset + size],)
+            offset += size
+        yield opcode, fields
+
+# A connection to the root object of a PB server. Messages are queued and sent
+# together, in a single remote call, when flush() is called once a tick.
+class BatchedConnection:
+    def __init__(self, addr, port):
         self.factory = pb.PBClientFactory()
-        reactor.connectTCP(addr, 8770, self.factory)
+        reactor.connectTCP(addr, port, self.factory)
+        self.root = None
+        self.outbox = []
+        # Whether the connection was lost. Messages sent after that are
+        # dropped.
+        self.lost = False
+        # Called, if given, once the connection is lost.
+        self.on_disconnect = None
+        self.factory.getRootObject().addCallback(self.connected)
+
+    def connected(self, root):
+        self.root = root
+        root.notifyOnDisconnect(self.disconnected)
+
+    def disconnected(self, root):
+        self.root = None
+        self.lost = True
+        self.outbox = []
+        if self.on_disconnect:
+            self.on_disconnect()
+
+    def send(self, pkt):
+        if not self.lost:
+            self.outbox.append(pkt)
+
+    @PROFILER.profile('network.send')
+    def flush(self, dt=None):
+        # Messages wait in the outbox until the root object is resolved.
+        if self.root is None or not self.outbox:
+            return
+        self.root.callRemote("receive", ''.join(self.outbox))
+        self.outbox = []
+
+class MultiplayerClientClient(BatchedConnection):
+    # A local client belongs to the player hosting the server, who shares
+    # its world and so needs no sectors sent.
+    def __init__(self, addr, local=False):
+        BatchedConnection.__init__(self, addr, 8770)
+        self.local = local
+        # Provided by the server once connected.
+        self.uuid = None
+        pyglet.clock.schedule_interval(self.flush, 1.0 / TICKS_PER_SEC)
         import socket
         
         # TODO: Rancid hack right here... Instead need to provide the IP address based on the interface Twisted is using.
@@ -1747,195 +4334,316 @@ class MultiplayerClientClient:
             if(re.match("192\.168\.1\.", ip)):
                 print "ASSIGNING IP ADDRESS::::::::" + ip
                 addr = ip
-        j = dict(msg="init", addr=addr)
-        self.send(j, False) # No UUID before connecting--UUID provided by server.
-
-    # include_uuid: Attempts to add (or modify existing) the uuid of the client to the request before sending.
-    def send(self, msg, include_uuid=True):
-        d = self.factory.getRootObject()
-        if include_uuid == True:
-            msg_fin = dict(msg)
-            msg_fin.update(uuid=self.uuid)
-        else:
-            msg_fin = msg
-        d.addCallback(lambda obj: obj.callRemote("receive", jsonpickle.encode(msg_fin, unpicklable=True)))
-        #d.addCallback(lambda echo: "server echoed: " + echo)
-
-def strToTuple3(t3_str):
-    splt = t3_str.split(",")
-    x = 0
-    while x < 3:
-        splt[x] = splt[x].replace("(", "").replace(")", "")
-        x += 1
-    return (float(str(splt[0]).strip()), float(str(splt[1]).strip()), float(str(splt[2]).strip()))
+        # No UUID before connecting--UUID provided by server.
+        self.send(encode_message(MSG_INIT, socket.inet_aton(addr)))
+
+    # Send one input of the player to the server. See Window._update().
+    def send_input(self, sequence, strafe, rotation, flags):
+        self.send(encode_message(MSG_INPUT, self.uuid, sequence, strafe[0], strafe[1], rotation[0], rotation[1], flags))
+
+    # Tell the server the player moved into `sector`, so it sends the sectors
+    # around it.
+    def send_view(self, sector):
+        if self.uuid is None or self.local:
+            return
+        self.send(encode_message(MSG_VIEW, self.uuid, *sector))
+
+    # Tell the server the player placed `block` at `position`, or removed the
+    # block there if `block` is None.
+    def send_block(self, position, block):
+        if self.uuid is None:
+            return
+        block_id = 0 if block is None else blockRegistry.ids[block]
+        self.send(encode_message(MSG_BLOCK, self.uuid, position[0], position[1], position[2], block_id))
 
 class MultiplayerClientServer(pb.Root):
     def __init__(self):
         reactor.listenTCP(8771, pb.PBServerFactory(self))
-        self.clientList = []
-
+        # Mapping from uuid to client.
+        self.clients = {}
+        # Messages without a handler are ignored.
+        self.handlers = {
+            MSG_UUID: self.receive_uuid,
+            MSG_PLAYER_POSITION: self.receive_player_position,
+            MSG_NETWORKPLAYER_POSITION: self.receive_networkplayer_position,
+            MSG_STATE: self.receive_state,
+            MSG_SECTOR: self.receive_sector,
+            MSG_BLOCK_DELTA: self.receive_block_delta,
+            MSG_NETWORKPLAYER_REMOVE: self.receive_networkplayer_remove,
+        }
+
+    @PROFILER.profile('network.client_receive')
     def remote_receive(self, pkt):
-        j = jsonpickle.decode(pkt)
-
-        print "CLIENT RECEIVE FIRED!"
-        print "MSG: " + j[u'msg']
-
-        if j[u'msg'] == "uuid":
-            print "server provided uuid: " + j[u'uuid']
-            global CLIENT
-            CLIENT.uuid = j[u'uuid']
-        elif j[u'msg'] == "player.position":
-            print "server provided player.position: " + j[u'position']
-            WINDOW.position = strToTuple3(j[u'position'])
-        elif j[u'msg'] == "action":
-            client = self.getClient(j[u'uuid'])
-
-            print "CLIENT RECEIVING ACTION: " + j[u'action']
-
-            print "POSITION::::::::" + j[u'position']
-
-            if j[u'action'] == "player.move.forward.start":
-                client[u'network_player'].strafe[0] -= 1
-            elif j[u'action'] == "player.move.forward.stop":
-                client[u'network_player'].strafe[0] += 1
-            elif j[u'action'] == "player.move.backwards.start":
-                client[u'network_player'].strafe[0] += 1
-            elif j[u'action'] == "player.move.backwards.stop":
-                client[u'network_player'].strafe[0] -= 1
-            elif j[u'action'] == "player.move.left.start":
-                client[u'network_player'].strafe[1] -= 1
-            elif j[u'action'] == "player.move.left.stop":
-                client[u'network_player'].strafe[1] += 1
-            elif j[u'action'] == "player.move.right.start":
-                client[u'network_player'].strafe[1] += 1
-            elif j[u'action'] == "player.move.right.stop":
-                client[u'network_player'].strafe[1] -= 1
-            elif j[u'action'] == "player.attack":
-                print "BLOCK POSITION: " + j[u'block_position']
-        elif j[u'msg'] == "networkplayer.position":
-            # TODO: Implement this... Following code is what's sent from the server:
-            #self.broadcastWithinRange(dict(msg="networkplayer.position", uuid=str(u), position=str(np.getPosition())), BROADCASTDISTANCE)
-            client = self.getClient(j[u'uuid'])
-            pos = strToTuple3(j[u'position'])
-            if not client:
-                u = j[u'uuid']
-                np = NetworkPlayer(pos)
-                self.clientList.append(dict(uuid=str(u), network_player=np))
-            else:
-                client[u'network_player'].setPosition(pos)
+        for opcode, fields in decode_messages(pkt):
+            handler = self.handlers.get(opcode)
+            if handler:
+                handler(*fields)
+
+    def receive_uuid(self, uuid):
+        global CLIENT
+        CLIENT.uuid = uuid
+        # The player may have entered its first sector before this arrived.
+        if WINDOW.sector is not None:
+            CLIENT.send_view(WINDOW.sector)
+
+    def receive_player_position(self, x, y, z):
+        WINDOW.teleport((x, y, z))
+
+    def receive_state(self, sequence, x, y, z, dy):
+        WINDOW.reconcile(sequence, (x, y, z), dy)
+
+    def receive_sector(self, x, y, z, sequence, blob):
+        if WINDOW.model.remote:
+            chunks = decode_chunks(zlib.decompress(blob))
+            WINDOW.model.apply_snapshot((x, y, z), sequence, chunks)
+
+    def receive_block_delta(self, sequence, x, y, z, block_id):
+        if WINDOW.model.remote:
+            WINDOW.model.apply_delta(sequence, (x, y, z), block_id)
+
+    # Other players are simulated by the server, which sends their position
+    # when they come into range and after each tick they move in.
+    def receive_networkplayer_position(self, uuid, x, y, z):
+        client = self.getClient(uuid)
+        pos = (x, y, z)
+        if not client:
+            np = NetworkPlayer(pos)
+            self.clients[uuid] = dict(uuid=uuid, network_player=np)
+        else:
+            client[u'network_player'].setPosition(pos)
 
-    # Accepts a uuid (string) and attempts to find a client from the clientList.
-    def getClient(self, uuid):
-        for client in self.clientList:
-            #print "PRINTING DEBUG DICT: " + jsonpickle.encode(client, unpicklable=True)
-            if client[u'uuid'] == uuid:
-                return client
-        return False
+    # The player went out of range or left, and is sent again if it comes
+    # back.
+    def receive_networkplayer_remove(self, uuid):
+        client = self.clients.pop(uuid, None)
+        if client:
+            client[u'network_player'].remove()
 
-    def update(self, dt):
-        for client in self.clientList:
-            client[u'network_player'].update(dt)
+    # Accepts a uuid (16 bytes) and attempts to find a client.
+    def getClient(self, uuid):
+        return self.clients.get(uuid, False)
+
+# A uniform grid over the x-z plane, keeping track of which cell each key's
+# position is in, so finding the keys near a position only looks at the
+# cells around it.
+class SpatialHash:
+    def __init__(self, cell_size):
+        self.cell_size = cell_size
+        # Mapping from cell to the set of keys in it.
+        self.cells = {}
+        # Mapping from key to its position and cell.
+        self.positions = {}
+
+    def cell(self, position):
+        x, _, z = position
+        return (int(math.floor(x / self.cell_size)), int(math.floor(z / self.cell_size)))
+
+    # Add `key` at `position`, or move it there.
+    def move(self, key, position):
+        cell = self.cell(position)
+        if key in self.positions:
+            old = self.positions[key][1]
+            if old != cell:
+                self.cells[old].discard(key)
+                if not self.cells[old]:
+                    del self.cells[old]
+        self.cells.setdefault(cell, set()).add(key)
+        self.positions[key] = (position, cell)
+
+    def remove(self, key):
+        position, cell = self.positions.pop(key)
+        self.cells[cell].discard(key)
+        if not self.cells[cell]:
+            del self.cells[cell]
+
+    # Yields the keys within `distance` of `position`.
+    def nearby(self, position, distance):
+        cx, cz = self.cell(position)
+        r = int(math.ceil(float(distance) / self.cell_size))
+        for dx in xrange(-r, r + 1):
+            for dz in xrange(-r, r + 1):
+                for member in self.cells.get((cx + dx, cz + dz), ()):
+                    if getDistance(position, self.positions[member][0]) < distance:
+                        yield member
 
 # Get the distance between two three dimensional points (tuples).
 def getDistance(xyz1, xyz2):
    return math.sqrt(math.pow(xyz1[0]-xyz2[0], 2) + math.pow(xyz1[1]-xyz2[1], 2) + math.pow(xyz1[2]-xyz2[2], 2))
 
-class MultiplayerServerClient:
-    def __init__(self, addr):
-        self.factory = pb.PBClientFactory()
-        reactor.connectTCP(addr, 8771, self.factory)
-    def send(self, msg):
-        d = self.factory.getRootObject()
-        d.addCallback(lambda obj: obj.callRemote("receive", msg))
+class MultiplayerServerClient(BatchedConnection):
+    def __init__(self, addr, on_disconnect=None):
+        BatchedConnection.__init__(self, addr, 8771)
+        self.on_disconnect = on_disconnect
 
 class MultiplayerServerServer(pb.Root):
     def __init__(self):
-        self.clientList = []
+        # Mapping from uuid to client.
+        self.clients = {}
+        # Where the players are, by uuid.
+        self.grid = SpatialHash(BROADCASTDISTANCE)
+        # Sequence number of the last block change.
+        self.block_sequence = 0
         reactor.listenTCP(8770, pb.PBServerFactory(self))
-
-    # Accepts a uuid (string) and attempts to find a client from the clientList.
+        # The server's simulation runs at a fixed tick.
+        pyglet.clock.schedule_interval(self.tick, 1.0 / TICKS_PER_SEC)
+        # Messages without a handler are ignored.
+        self.handlers = {
+            MSG_INIT: self.receive_init,
+            MSG_INPUT: self.receive_input,
+            MSG_VIEW: self.receive_view,
+            MSG_BLOCK: self.receive_block,
+        }
+
+    # Accepts a uuid (16 bytes) and attempts to find a client.
     def getClient(self, uuid):
-        for client in self.clientList:
-            #print "PRINTING DEBUG DICT: " + jsonpickle.encode(client, unpicklable=True)
-            if client[u'uuid'] == uuid:
-                return client
-        return False
-
-    # Broadcast a packet consisting of a dict, which contains uuid of the broadcaster.
-    # Optional c_op parameter accepts a function which gets called for each valid client found to broadcast to.
-    #   The current found client is passed into c_op when called.
-    '''
-    def broadcastWithinRange(self, pkt, distance, c_op=False):
-        for c in self.clientList:
-            # Make sure the packet being broadcast isn't sent back to the broadcaster.
-            if(c[u'uuid'] != pkt[u'uuid']):
-                if(getDistance(self.getClient(pkt[u'uuid'])[u'network_player'].getPosition(), c[u'network_player'].getPosition()) < distance):
-                    if(c_op) != False:
-                        c_op(c)
-                    c[u'server_client'].send(jsonpickle.encode(pkt))
-    '''
-
-    # For testing purposes, send to all clients except for the sender.
-    def broadcastWithinRange(self, pkt, distance, c_op=False):
-            for c in self.clientList:
-                # Make sure the packet being broadcast isn't sent back to the broadcaster.
-                if(c[u'uuid'] != pkt[u'uuid']):
-                    c[u'server_client'].send(jsonpickle.encode(pkt))
-
-
+        return self.clients.get(uuid, False)
+
+    # Run the inputs each player sent since the last tick, in order and
+    # batched across players, with the sectors around them loaded, tell each
+    # player the result, tell everyone
+    # about the players that came into or went out of their range or moved
+    # within it, send the next few sectors each player is missing, then send
+    # the messages queued for each client.
+    @PROFILER.profile('server.tick')
+    def tick(self, dt=None):
+        step = 1.0 / TICKS_PER_SEC
+        # The inputs run in rounds, the first input of every player with one
+        # left together in each round.
+        last = {}
+        active = [c for c in self.clients.itervalues() if c[u'inputs']]
+        while active:
+            inputs = []
+            for c in active:
+                self.pin_sectors(c)
+                sequence, strafe, rotation, flags = c[u'inputs'].popleft()
+                last[c[u'uuid']] = sequence
+                inputs.append((strafe, rotation, flags))
+            NetworkPlayer.apply_inputs([c[u'network_player'] for c in active], inputs, step)
+            active = [c for c in active if c[u'inputs']]
+        for uuid, sequence in last.iteritems():
+            c = self.clients[uuid]
+            np = c[u'network_player']
+            position = np.getPosition()
+            self.grid.move(uuid, position)
+            c[u'server_client'].send(encode_message(MSG_STATE, sequence, position[0], position[1], position[2], np.dy))
+        for c in self.clients.itervalues():
+            self.send_players(c, last)
+            self.send_sectors(c)
+            c[u'server_client'].flush()
+
+    # Send the client the position of the players that came into its range or
+    # moved within it, of those in `moved`, and remove those that went out of
+    # it.
+    def send_players(self, c, moved):
+        position = c[u'network_player'].getPosition()
+        visible = set(self.grid.nearby(position, BROADCASTDISTANCE))
+        visible.discard(c[u'uuid'])
+        for other in visible:
+            if other not in c[u'visible'] or other in moved:
+                pos = self.clients[other][u'network_player'].getPosition()
+                c[u'server_client'].send(encode_message(MSG_NETWORKPLAYER_POSITION, other, *pos))
+        for other in c[u'visible'] - visible:
+            c[u'server_client'].send(encode_message(MSG_NETWORKPLAYER_REMOVE, other))
+        c[u'visible'] = visible
+
+    # Keep the sectors around the client's player loaded, so it has ground
+    # to stand on wherever the host goes.
+    def pin_sectors(self, c):
+        sector = sectorize(c[u'network_player'].getPosition())
+        if sector != c[u'sector']:
+            WINDOW.model.pin(c[u'uuid'], sectors_around(sector, 1, 1))
+            c[u'sector'] = sector
+
+    # Forget a client whose connection was lost, and remove its player from
+    # the clients that could see it.
+    def remove_client(self, uuid):
+        if self.clients.pop(uuid, None) is None:
+            return
+        print "Server client left: " + uuid.encode('hex')
+        self.grid.remove(uuid)
+        WINDOW.model.unpin(uuid)
+        for c in self.clients.itervalues():
+            if uuid in c[u'visible']:
+                c[u'visible'].discard(uuid)
+                c[u'server_client'].send(encode_message(MSG_NETWORKPLAYER_REMOVE, uuid))
+
+    # Send the client a snapshot of the nearest sectors it is missing.
+    def send_sectors(self, c):
+        model = WINDOW.model
+        queue = c[u'queue']
+        budget = SNAPSHOTS_PER_TICK
+        while queue and budget:
+            sector = queue.popleft()
+            chunks = model.sector_snapshot(sector)
+            if chunks:
+                budget -= 1
+            blob = zlib.compress(encode_chunks(chunks))
+            c[u'server_client'].send(encode_message(MSG_SECTOR, sector[0], sector[1], sector[2], self.block_sequence, blob))
+            c[u'sent'].add(sector)
+
+    @PROFILER.profile('network.server_receive')
     def remote_receive(self, pkt):
-        j = jsonpickle.decode(pkt)
-        global BROADCASTDISTANCE
-
-        if j[u'msg'] == "init":
-            print "Server init incoming: " + j[u'addr']
-            serverClient = MultiplayerServerClient(j[u'addr'])
-            import uuid
-            u = uuid.uuid4()
-            global STARTING_POSITION
-            np = NetworkPlayer(STARTING_POSITION)
-            self.clientList.append(dict(uuid=str(u), server_client=serverClient, network_player=np))
-            serverClient.send(jsonpickle.encode(dict(msg="uuid", uuid=str(u)), unpicklable=True))
-            serverClient.send(jsonpickle.encode(dict(msg="player.position", position=str(np.getPosition())), unpicklable=True))
-            self.broadcastWithinRange(dict(msg="networkplayer.position", uuid=str(u), position=str(np.getPosition())), BROADCASTDISTANCE)
-
-        elif j[u'msg'] == "action":
-            print "SERVER ACTION: " + j[u'action']
-
-            np = self.getClient(j[u'uuid'])[u'network_player']
-
-            if j[u'action'] == "player.move.forward.start":
-                def op(client):
-                    client[u'network_player'].strafe[0] -= 1
-                self.broadcastWithinRange(dict(msg="action", action=j[u'action'], uuid=j[u'uuid'], position=str(np.getPosition())), BROADCASTDISTANCE, op)
-            elif j[u'action'] == "player.move.forward.stop":
-                def op(client):
-                    client[u'network_player'].strafe[0] += 1
-                self.broadcastWithinRange(dict(msg="action", action=j[u'action'], uuid=j[u'uuid'], position=str(np.getPosition())), BROADCASTDISTANCE, op)
-            elif j[u'action'] == "player.move.backwards.start":
-                def op(client):
-                    client[u'network_player'].strafe[0] += 1
-                self.broadcastWithinRange(dict(msg="action", action=j[u'action'], uuid=j[u'uuid'], position=str(np.getPosition())), BROADCASTDISTANCE, op)
-            elif j[u'action'] == "player.move.backwards.stop":
-                def op(client):
-                    client[u'network_player'].strafe[0] -= 1
-                self.broadcastWithinRange(dict(msg="action", action=j[u'action'], uuid=j[u'uuid'], position=str(np.getPosition())), BROADCASTDISTANCE, op)
-            elif j[u'action'] == "player.move.left.start":
-                def op(client):
-                    client[u'network_player'].strafe[1] -= 1
-                self.broadcastWithinRange(dict(msg="action", action=j[u'action'], uuid=j[u'uuid'], position=str(np.getPosition())), BROADCASTDISTANCE, op)
-            elif j[u'action'] == "player.move.left.stop":
-                def op(client):
-                    client[u'network_player'].strafe[1] += 1
-                self.broadcastWithinRange(dict(msg="action", action=j[u'action'], uuid=j[u'uuid'], position=str(np.getPosition())), BROADCASTDISTANCE, op)
-            elif j[u'action'] == "player.move.right.start":
-                def op(client):
-                    client[u'network_player'].strafe[1] += 1
-                self.broadcastWithinRange(dict(msg="action", action=j[u'action'], uuid=j[u'uuid'], position=str(np.getPosition())), BROADCASTDISTANCE, op)
-            elif j[u'action'] == "player.move.right.stop":
-                def op(client):
-                    client[u'network_player'].strafe[1] -= 1
-                self.broadcastWithinRange(dict(msg="action", action=j[u'action'], uuid=j[u'uuid'], position=str(np.getPosition())), BROADCASTDISTANCE, op)
+        for opcode, fields in decode_messages(pkt):
+            handler = self.handlers.get(opcode)
+            if handler:
+                handler(*fields)
+
+    def receive_init(self, addr):
+        import socket
+        addr = socket.inet_ntoa(addr)
+        print "Server init incoming: " + addr
+        import uuid
+        u = uuid.uuid4().bytes
+        serverClient = MultiplayerServerClient(addr, lambda: self.remove_client(u))
+        global STARTING_POSITION
+        np = NetworkPlayer(STARTING_POSITION, visible=False)
+        # The client is sent the sectors in its queue, nearest first, and then
+        # the changes to the sectors it was sent. `visible` holds the players
+        # it was last told are in its range; it and they are told about each
+        # other on the next tick. `sector` is the one its player was last
+        # in, with the sectors around it pinned in the model.
+        self.clients[u] = dict(uuid=u, server_client=serverClient, network_player=np, inputs=deque(), sent=set(), queue=deque(), visible=set(), sector=None)
+        self.pin_sectors(self.clients[u])
+        self.grid.move(u, np.getPosition())
+        serverClient.send(encode_message(MSG_UUID, u))
+        serverClient.send(encode_message(MSG_PLAYER_POSITION, *np.getPosition()))
+
+    # Inputs are queued and run on the next tick.
+    def receive_input(self, uuid, sequence, forward, sideways, x, y, flags):
+        client = self.getClient(uuid)
+        if client:
+            client[u'inputs'].append((sequence, (forward, sideways), (x, y), flags))
+
+    # Queue the sectors needed around the player's new sector it doesn't
+    # have yet, nearest first, and forget the ones it will drop.
+    def receive_view(self, uuid, x, y, z):
+        client = self.getClient(uuid)
+        if not client:
+            return
+        wanted = sectors_needed(sectors_around((x, y, z)))
+        client[u'sent'] &= wanted
+        missing = sorted(wanted - client[u'sent'],
+            key=lambda s: (s[0] - x) ** 2 + (s[1] - y) ** 2 + (s[2] - z) ** 2)
+        client[u'queue'] = deque(missing)
+
+    # Apply a block change, and send it to the players that have its sector.
+    def receive_block(self, uuid, x, y, z, block_id):
+        if not self.getClient(uuid) or block_id >= len(blockRegistry.blocks):
+            return
+        model = WINDOW.model
+        position = (x, y, z)
+        sector = sectorize(position)
+        model.ensure_generated(sector)
+        if model.world.get_id(position) != block_id:
+            if block_id:
+                model.add_block(position, blockRegistry.blocks[block_id])
+            else:
+                model.remove_block(position)
+        self.block_sequence += 1
+        pkt = encode_message(MSG_BLOCK_DELTA, self.block_sequence, x, y, z, block_id)
+        for c in self.clients.itervalues():
+            if sector in c[u'sent']:
+                c[u'server_client'].send(pkt)
 
 
 '''